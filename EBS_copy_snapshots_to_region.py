@@ -0,0 +1,158 @@
+import argparse
+import time
+from collections import deque
+
+import boto3
+import botocore.exceptions
+
+# Copies a snapshot list to another region, keeping as many copies in flight as
+# the destination region allows and retrying transient failures.
+# usage: python EBS_copy_snapshots_to_region.py snapshots.txt --source-region us-east-1 --destination-region us-west-2
+
+# Errors worth retrying; ResourceLimitExceeded means the concurrent copy limit was hit
+TRANSIENT_ERRORS = {
+    "RequestLimitExceeded",
+    "ResourceLimitExceeded",
+    "InternalError",
+    "ServiceUnavailable",
+}
+
+
+def read_snapshot_ids(file_path):
+    with open(file_path) as file:
+        return [line.strip() for line in file if line.strip()]
+
+
+# Start a copy, returning the new snapshot ID or the error; neither means retry later
+def start_copy(ec2_client, snapshot_id, source_region, kms_key_id):
+    kwargs = {
+        "SourceSnapshotId": snapshot_id,
+        "SourceRegion": source_region,
+        "Description": f"Copy of {snapshot_id} from {source_region}",
+    }
+    if kms_key_id:
+        kwargs["Encrypted"] = True
+        kwargs["KmsKeyId"] = kms_key_id
+
+    try:
+        return ec2_client.copy_snapshot(**kwargs)["SnapshotId"], None
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in TRANSIENT_ERRORS:
+            return None, None
+        return None, str(e)
+
+
+# Current state of the in-flight copies, described in batches
+def get_copy_states(ec2_client, snapshot_ids, batch_size=200):
+    states = {}
+    for i in range(0, len(snapshot_ids), batch_size):
+        response = ec2_client.describe_snapshots(
+            Filters=[
+                {"Name": "snapshot-id", "Values": snapshot_ids[i : i + batch_size]}
+            ]
+        )
+        for snapshot in response["Snapshots"]:
+            states[snapshot["SnapshotId"]] = snapshot["State"]
+    return states
+
+
+def copy_snapshots(
+    snapshot_ids,
+    source_region,
+    destination_region,
+    max_concurrent,
+    kms_key_id=None,
+    max_attempts=5,
+    poll_interval=30,
+):
+    # Copies are started from the destination region
+    ec2_client = boto3.client("ec2", region_name=destination_region)
+
+    queue = deque(snapshot_ids)
+    attempts = dict.fromkeys(snapshot_ids, 0)
+    in_flight = {}
+    copied = {}
+    failed = {}
+
+    while queue or in_flight:
+        # Keep the copy pipeline full up to the concurrency limit
+        while queue and len(in_flight) < max_concurrent:
+            snapshot_id = queue.popleft()
+            copy_id, error = start_copy(
+                ec2_client, snapshot_id, source_region, kms_key_id
+            )
+            if copy_id:
+                attempts[snapshot_id] += 1
+                in_flight[copy_id] = snapshot_id
+            elif error:
+                failed[snapshot_id] = error
+                print(f"Error copying snapshot: {snapshot_id}. Error: {error}")
+            else:
+                # Throttled or at the copy limit: try again after the next poll
+                queue.appendleft(snapshot_id)
+                break
+
+        time.sleep(poll_interval)
+
+        for copy_id, state in get_copy_states(ec2_client, list(in_flight)).items():
+            snapshot_id = in_flight[copy_id]
+            if state == "completed":
+                del in_flight[copy_id]
+                copied[snapshot_id] = copy_id
+                print(f"Copied snapshot: {snapshot_id} -> {copy_id}")
+            elif state == "error":
+                del in_flight[copy_id]
+                if attempts[snapshot_id] < max_attempts:
+                    queue.append(snapshot_id)
+                else:
+                    failed[snapshot_id] = f"Copy {copy_id} failed"
+                    print(
+                        f"Error copying snapshot: {snapshot_id}. Error: {failed[snapshot_id]}"
+                    )
+
+        print(
+            f"Copied: {len(copied)}, In flight: {len(in_flight)}, Queued: {len(queue)}, Failed: {len(failed)}"
+        )
+
+    return copied, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Copy a list of EBS snapshots to another region."
+    )
+    parser.add_argument(
+        "file_path", help="Path to the file containing the list of Snapshot IDs"
+    )
+    parser.add_argument("--source-region", required=True, help="Region to copy from")
+    parser.add_argument("--destination-region", required=True, help="Region to copy to")
+    parser.add_argument(
+        "--max-concurrent",
+        type=int,
+        default=20,
+        help="Concurrent copy limit of the destination region (default: 20)",
+    )
+    parser.add_argument(
+        "--kms-key-id", help="KMS key to encrypt the copies with in the destination"
+    )
+    parser.add_argument(
+        "--output", help="Write 'source_id,copy_id' lines for the copied snapshots"
+    )
+    args = parser.parse_args()
+
+    copied, _ = copy_snapshots(
+        read_snapshot_ids(args.file_path),
+        args.source_region,
+        args.destination_region,
+        args.max_concurrent,
+        args.kms_key_id,
+    )
+
+    if args.output:
+        with open(args.output, "w") as file:
+            for snapshot_id, copy_id in copied.items():
+                file.write(f"{snapshot_id},{copy_id}\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,635 @@
 import argparse
+import concurrent.futures
+import json
+import os
+import random
+import time
 
 import boto3
+import botocore.exceptions
 
-# Define argument parser
-parser = argparse.ArgumentParser(description="Delete specific AWS EBS volumes.")
-parser.add_argument("file", help="Text file with volume IDs, one per line.")
-
-# Parse arguments
-args = parser.parse_args()
-
-# Create a session using your AWS credentials
-session = boto3.Session()
-
-# Create an EC2 resource object using the defined session
-ec2_resource = session.resource("ec2")
-
-# Read the volume IDs from the text file
-with open(args.file) as file:
-    volume_ids = [line.strip() for line in file]
-
-# Iterate over each volume ID
-for volume_id in volume_ids:
-    # Load volume information
-    volume = ec2_resource.Volume(volume_id)
-
-    # Check if the volume is available, not encrypted and has 'remediated' tag
-    if volume.state == "available" and not volume.encrypted:
-        if volume.tags:
-            for tag in volume.tags:
-                if tag["Key"] == "remediated":
-                    # Delete the volume
-                    volume.delete()
-                    print(f"Deleted volume: {volume_id}")
-                    break
+
+# Every volume that is available, unencrypted and tagged 'remediated', in one listing
+def get_remediated_volume_ids(ec2_client):
+    volume_ids = set()
+    paginator = ec2_client.get_paginator("describe_volumes")
+    for page in paginator.paginate(
+        Filters=[
+            {"Name": "status", "Values": ["available"]},
+            {"Name": "encrypted", "Values": ["false"]},
+            {"Name": "tag-key", "Values": ["remediated"]},
+        ]
+    ):
+        for volume in page["Volumes"]:
+            volume_ids.add(volume["VolumeId"])
+    return volume_ids
+
+
+# Make an API call, backing off while the API is throttling us
+def call_with_backoff(call, max_attempts=8, **kwargs):
+    for attempt in range(max_attempts):
+        try:
+            return call(**kwargs)
+        except botocore.exceptions.ClientError as e:
+            throttled = e.response["Error"]["Code"] == "RequestLimitExceeded"
+            if not throttled or attempt == max_attempts - 1:
+                raise
+            time.sleep(min(2**attempt, 30) + random.uniform(0, 1))
+
+
+def delete_volume(ec2_client, volume_id):
+    try:
+        call_with_backoff(ec2_client.delete_volume, VolumeId=volume_id)
+        return None
+    except botocore.exceptions.ClientError as e:
+        return str(e)
+
+
+# Describe resources of one kind by ID, in batches of filter values
+def describe_by_id(ec2_client, kind, resource_ids, batch_size=200):
+    call, id_filter, key, id_key = {
+        "snapshot": (
+            ec2_client.describe_snapshots,
+            "snapshot-id",
+            "Snapshots",
+            "SnapshotId",
+        ),
+        "volume": (ec2_client.describe_volumes, "volume-id", "Volumes", "VolumeId"),
+        "instance": (
+            ec2_client.describe_instances,
+            "instance-id",
+            "Reservations",
+            "InstanceId",
+        ),
+    }[kind]
+    resources = {}
+    resource_ids = list(resource_ids)
+    for i in range(0, len(resource_ids), batch_size):
+        filters = [{"Name": id_filter, "Values": resource_ids[i : i + batch_size]}]
+        for item in call_with_backoff(call, Filters=filters)[key]:
+            # Instances come wrapped in reservations
+            for resource in item["Instances"] if kind == "instance" else [item]:
+                resources[resource[id_key]] = resource
+    return resources
+
+
+def load_remediation_state(state_file):
+    if not os.path.exists(state_file):
+        return {"volumes": {}, "instances": {}}
+    with open(state_file) as f:
+        return json.load(f)
+
+
+# Write the whole state to a temporary file first so a crash never leaves it half-written
+def save_remediation_state(state, state_file):
+    with open(f"{state_file}.tmp", "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(f"{state_file}.tmp", state_file)
+
+
+def add_volumes_to_state(ec2_client, volume_ids, state):
+    volumes = describe_by_id(ec2_client, "volume", volume_ids)
+    for volume_id in volume_ids:
+        if volume_id in state["volumes"]:
+            continue
+        volume = volumes.get(volume_id)
+        if not volume:
+            print(f"Skipping volume {volume_id}: not found.")
+            continue
+        if volume["Encrypted"]:
+            print(f"Skipping volume {volume_id}: already encrypted.")
+            continue
+
+        attachment = (volume.get("Attachments") or [{}])[0]
+        state["volumes"][volume_id] = {
+            "step": "pending",
+            "availability_zone": volume["AvailabilityZone"],
+            "volume_type": volume["VolumeType"],
+            "iops": volume.get("Iops"),
+            "throughput": volume.get("Throughput"),
+            "tags": volume.get("Tags", []),
+            "instance_id": attachment.get("InstanceId"),
+            "device": attachment.get("Device"),
+            "delete_on_termination": attachment.get("DeleteOnTermination", False),
+        }
+
+
+class RemediationError(Exception):
+    pass
+
+
+# Tags on every snapshot and volume the pipeline creates, so a resumed run can
+# find what an interrupted call already created
+SOURCE_TAG = "remediation-source-volume"
+STAGE_TAG = "remediation-stage"
+ATTEMPT_TAG = "remediation-attempt"
+
+
+def get_remediation_tags(volume_id, volume, stage):
+    return [
+        {"Key": SOURCE_TAG, "Value": volume_id},
+        {"Key": STAGE_TAG, "Value": stage},
+        {"Key": ATTEMPT_TAG, "Value": str(volume.get("attempt", 0))},
+    ]
+
+
+def find_created_resource(ec2_client, kind, volume_id, volume, stage):
+    filters = [
+        {"Name": f"tag:{tag['Key']}", "Values": [tag["Value"]]}
+        for tag in get_remediation_tags(volume_id, volume, stage)
+    ]
+    if kind == "snapshot":
+        response = call_with_backoff(
+            ec2_client.describe_snapshots, OwnerIds=["self"], Filters=filters
+        )
+        resources, id_key = response["Snapshots"], "SnapshotId"
+    else:
+        response = call_with_backoff(ec2_client.describe_volumes, Filters=filters)
+        resources, id_key = response["Volumes"], "VolumeId"
+    usable = [r[id_key] for r in resources if r["State"] != "error"]
+    return usable[0] if usable else None
+
+
+# Create a snapshot or volume at most once per stage, even across crashes
+def issue_create(ec2_client, volume_id, volume, save, stage, kind, call, **kwargs):
+    # The marker is saved before the call; if it is still set, an earlier run
+    # may have created the resource without recording its ID
+    if volume.get("issuing") == stage:
+        resource_id = find_created_resource(ec2_client, kind, volume_id, volume, stage)
+        if resource_id:
+            volume.pop("issuing")
+            return resource_id
+
+    volume["issuing"] = stage
+    save()
+    tags = get_remediation_tags(volume_id, volume, stage) + kwargs.pop("tags", [])
+    response = call_with_backoff(
+        call, TagSpecifications=[{"ResourceType": kind, "Tags": tags}], **kwargs
+    )
+    volume.pop("issuing")
+    return response["SnapshotId" if kind == "snapshot" else "VolumeId"]
+
+
+# Whether a described volume is attached, or being attached, to the instance,
+# optionally at a specific device
+def is_attached(described_volume, instance_id, device=None):
+    return any(
+        attachment["InstanceId"] == instance_id
+        and attachment["State"] in ("attaching", "attached")
+        and device in (None, attachment["Device"])
+        for attachment in described_volume.get("Attachments", [])
+    )
+
+
+def check_instance(volume, resources):
+    instance = resources["instance"].get(volume["instance_id"])
+    if not instance or instance["State"]["Name"] in ("shutting-down", "terminated"):
+        raise RemediationError(
+            f"Instance {volume['instance_id']} is missing or terminated"
+        )
+    return instance
+
+
+# Each handler performs one step for a volume whose previous step has finished
+# and returns the next step, or None while it is still waiting. A failed
+# snapshot or volume moves the volume back to the step that creates it, so
+# the next run tries again.
+#
+# Attached volumes are snapshotted only once their instance has stopped, so
+# nothing written after the snapshot is lost when the volumes are swapped.
+def step_pending(ec2_client, volume_id, volume, resources, save):
+    if volume["instance_id"]:
+        check_instance(volume, resources)
+        call_with_backoff(
+            ec2_client.stop_instances, InstanceIds=[volume["instance_id"]]
+        )
+    return "stopping"
+
+
+def step_stopping(ec2_client, volume_id, volume, resources, save):
+    if volume["instance_id"]:
+        instance = check_instance(volume, resources)
+        if instance["State"]["Name"] != "stopped":
+            return None
+    volume["snapshot_id"] = issue_create(
+        ec2_client,
+        volume_id,
+        volume,
+        save,
+        "snapshot",
+        "snapshot",
+        ec2_client.create_snapshot,
+        VolumeId=volume_id,
+        Description=f"Encryption remediation of {volume_id}",
+    )
+    return "snapshotting"
+
+
+def step_snapshotting(ec2_client, volume_id, volume, resources, save):
+    snapshot = resources["snapshot"].get(volume["snapshot_id"], {})
+    if snapshot.get("State") == "error":
+        volume["step"] = "stopping"
+        raise RemediationError(f"Snapshot {volume['snapshot_id']} failed")
+    if snapshot.get("State") != "completed":
+        return None
+    kwargs = {
+        "SourceSnapshotId": volume["snapshot_id"],
+        "SourceRegion": ec2_client.meta.region_name,
+        "Encrypted": True,
+        "Description": f"Encrypted copy for {volume_id}",
+    }
+    if volume.get("kms_key_id"):
+        kwargs["KmsKeyId"] = volume["kms_key_id"]
+    volume["encrypted_snapshot_id"] = issue_create(
+        ec2_client,
+        volume_id,
+        volume,
+        save,
+        "encrypted-copy",
+        "snapshot",
+        ec2_client.copy_snapshot,
+        **kwargs,
+    )
+    return "copying"
+
+
+def step_copying(ec2_client, volume_id, volume, resources, save):
+    snapshot = resources["snapshot"].get(volume["encrypted_snapshot_id"], {})
+    if snapshot.get("State") == "error":
+        volume["step"] = "snapshotting"
+        raise RemediationError(
+            f"Encrypted copy {volume['encrypted_snapshot_id']} failed"
+        )
+    if snapshot.get("State") != "completed":
+        return None
+    kwargs = {
+        "AvailabilityZone": volume["availability_zone"],
+        "SnapshotId": volume["encrypted_snapshot_id"],
+        "VolumeType": volume["volume_type"],
+        # A new token per attempt, so retrying after a failed volume creates another
+        "ClientToken": f"{volume_id}-remediation-{volume.get('attempt', 0)}",
+    }
+    if volume["volume_type"] in ("io1", "io2", "gp3") and volume["iops"]:
+        kwargs["Iops"] = volume["iops"]
+    if volume["volume_type"] == "gp3" and volume["throughput"]:
+        kwargs["Throughput"] = volume["throughput"]
+    # Carry the old volume's tags over, except AWS-reserved ones
+    tags = [t for t in volume["tags"] if not t["Key"].startswith("aws:")]
+    volume["new_volume_id"] = issue_create(
+        ec2_client,
+        volume_id,
+        volume,
+        save,
+        "volume",
+        "volume",
+        ec2_client.create_volume,
+        tags=tags,
+        **kwargs,
+    )
+    return "creating_volume"
+
+
+def step_creating_volume(ec2_client, volume_id, volume, resources, save):
+    new_volume = resources["volume"].get(volume["new_volume_id"], {})
+    if new_volume.get("State") == "error":
+        volume["step"] = "copying"
+        volume["attempt"] = volume.get("attempt", 0) + 1
+        raise RemediationError(f"Volume {volume['new_volume_id']} failed")
+    if new_volume.get("State") != "available":
+        return None
+    # Unattached volumes only need the old one tagged
+    if not volume["instance_id"]:
+        return step_attaching(ec2_client, volume_id, volume, resources, save)
+    check_instance(volume, resources)
+    # Detach and attach are not idempotent, so a resumed run checks whether an
+    # interrupted one already made the call
+    old_volume = resources["volume"].get(volume_id, {})
+    if is_attached(old_volume, volume["instance_id"]):
+        call_with_backoff(
+            ec2_client.detach_volume,
+            VolumeId=volume_id,
+            InstanceId=volume["instance_id"],
+        )
+    return "detaching"
+
+
+def step_detaching(ec2_client, volume_id, volume, resources, save):
+    check_instance(volume, resources)
+    if resources["volume"].get(volume_id, {}).get("State") != "available":
+        return None
+    new_volume = resources["volume"].get(volume["new_volume_id"], {})
+    if not is_attached(new_volume, volume["instance_id"], volume["device"]):
+        call_with_backoff(
+            ec2_client.attach_volume,
+            VolumeId=volume["new_volume_id"],
+            InstanceId=volume["instance_id"],
+            Device=volume["device"],
+        )
+    return "attaching"
+
+
+def step_attaching(ec2_client, volume_id, volume, resources, save):
+    if volume["instance_id"]:
+        check_instance(volume, resources)
+        new_volume = resources["volume"].get(volume["new_volume_id"], {})
+        if new_volume.get("State") != "in-use":
+            return None
+        # A newly attached volume does not inherit the old attachment's setting
+        if volume.get("delete_on_termination"):
+            call_with_backoff(
+                ec2_client.modify_instance_attribute,
+                InstanceId=volume["instance_id"],
+                BlockDeviceMappings=[
+                    {
+                        "DeviceName": volume["device"],
+                        "Ebs": {"DeleteOnTermination": True},
+                    }
+                ],
+            )
+    call_with_backoff(
+        ec2_client.create_tags,
+        Resources=[volume_id],
+        Tags=[{"Key": "remediated", "Value": volume["new_volume_id"]}],
+    )
+    return "remediated"
+
+
+STEPS = {
+    "pending": step_pending,
+    "stopping": step_stopping,
+    "snapshotting": step_snapshotting,
+    "copying": step_copying,
+    "creating_volume": step_creating_volume,
+    "detaching": step_detaching,
+    "attaching": step_attaching,
+}
+
+
+# Describe everything the active volumes are waiting on with a few batched calls
+def describe_waiting_resources(ec2_client, active):
+    snapshot_ids = set()
+    volume_ids = set()
+    instance_ids = set()
+    for volume_id, volume in active.items():
+        if volume["step"] == "snapshotting":
+            snapshot_ids.add(volume["snapshot_id"])
+        elif volume["step"] == "copying":
+            snapshot_ids.add(volume["encrypted_snapshot_id"])
+        elif volume["step"] in ("creating_volume", "detaching", "attaching"):
+            # Both volumes, so the swap can check the actual attachments
+            volume_ids.update([volume_id, volume["new_volume_id"]])
+        if volume["instance_id"]:
+            instance_ids.add(volume["instance_id"])
+    return {
+        "snapshot": describe_by_id(ec2_client, "snapshot", snapshot_ids),
+        "volume": describe_by_id(ec2_client, "volume", volume_ids),
+        "instance": describe_by_id(ec2_client, "instance", instance_ids),
+    }
+
+
+# Start an instance again once none of its volumes is still being remediated
+# and every failed one left either the old or the new volume attached at its
+# device. Which one is attached is read from EC2, not inferred from the step.
+# Returns why each blocked instance was left stopped.
+def restart_instances(ec2_client, state):
+    blocked = {}
+    candidates = {}
+    for instance_id, instance in state["instances"].items():
+        if instance.get("restarted") or not instance["was_running"]:
+            continue
+        volumes = {
+            volume_id: v
+            for volume_id, v in state["volumes"].items()
+            if v["instance_id"] == instance_id
+        }
+        if all(v["step"] == "remediated" or "error" in v for v in volumes.values()):
+            candidates[instance_id] = volumes
+
+    failed_volume_ids = set()
+    for volumes in candidates.values():
+        for volume_id, volume in volumes.items():
+            if "error" in volume:
+                failed_volume_ids.add(volume_id)
+                if volume.get("new_volume_id"):
+                    failed_volume_ids.add(volume["new_volume_id"])
+    described = describe_by_id(ec2_client, "volume", failed_volume_ids)
+
+    for instance_id, volumes in candidates.items():
+        reset = []
+        for volume_id, volume in volumes.items():
+            if "error" not in volume:
+                continue
+            device = volume["device"]
+            if is_attached(described.get(volume_id, {}), instance_id, device):
+                reset.append(volume)
+            elif not is_attached(
+                described.get(volume.get("new_volume_id"), {}), instance_id, device
+            ):
+                blocked[
+                    instance_id
+                ] = f"nothing is attached at {device} after volume {volume_id} failed"
+                break
+        else:
+            call_with_backoff(ec2_client.start_instances, InstanceIds=[instance_id])
+            state["instances"][instance_id]["restarted"] = True
+            print(f"Started instance {instance_id}")
+            # Anything copied from a volume that is still attached predates
+            # the restart, so a retry has to stop the instance and snapshot again
+            for volume in reset:
+                volume["step"] = "pending"
+                volume["attempt"] = volume.get("attempt", 0) + 1
+                volume.pop("issuing", None)
+    return blocked
+
+
+def remediate_volumes(
+    file_path, state_file, max_in_flight, kms_key_id=None, poll_interval=30
+):
+    ec2_client = boto3.Session().client("ec2")
+
+    with open(file_path) as file:
+        volume_ids = [line.strip() for line in file if line.strip()]
+
+    state = load_remediation_state(state_file)
+    add_volumes_to_state(ec2_client, volume_ids, state)
+
+    remaining = {
+        volume_id: volume
+        for volume_id, volume in state["volumes"].items()
+        if volume["step"] != "remediated"
+    }
+    instance_ids = sorted({v["instance_id"] for v in remaining.values()} - {None})
+    print(f"Volumes to replace with encrypted copies ({len(remaining)}):")
+    for volume_id, volume in remaining.items():
+        print(f"{volume_id} ({volume['instance_id'] or 'unattached'})")
+    print(
+        f"Instances that will be stopped while their volumes are swapped ({len(instance_ids)}):"
+    )
+    for instance_id in instance_ids:
+        print(instance_id)
+    confirm = input(
+        "WARNING: You are about to stop these instances and replace their volumes. Do you want to proceed? (y/n): "
+    )
+    if confirm.lower() != "y":
+        print("Exiting without remediating any volumes.")
+        return
+
+    for volume in state["volumes"].values():
+        # Errors from an earlier run are retried from the step that failed
+        volume.pop("error", None)
+        volume.setdefault("kms_key_id", kms_key_id)
+    save_remediation_state(state, state_file)
+
+    def save():
+        save_remediation_state(state, state_file)
+
+    while True:
+        unfinished = {
+            volume_id: volume
+            for volume_id, volume in state["volumes"].items()
+            if volume["step"] != "remediated" and "error" not in volume
+        }
+        if not unfinished:
+            break
+
+        # Only start new volumes while fewer than max_in_flight are under way
+        active = {k: v for k, v in unfinished.items() if v["step"] != "pending"}
+        for volume_id, volume in unfinished.items():
+            if volume["step"] == "pending" and len(active) < max_in_flight:
+                active[volume_id] = volume
+
+        resources = describe_waiting_resources(ec2_client, active)
+
+        # Remember which instances were running before we stop them, and save
+        # that before any stop_instances call. An instance restarted earlier is
+        # recorded again when another of its volumes is about to stop it.
+        for volume in active.values():
+            instance_id = volume["instance_id"]
+            if not instance_id or volume["step"] != "pending":
+                continue
+            instance = state["instances"].get(instance_id)
+            if not instance or instance.get("restarted"):
+                instance = resources["instance"].get(instance_id, {})
+                running = instance.get("State", {}).get("Name") == "running"
+                state["instances"][instance_id] = {"was_running": running}
+        save()
+
+        for volume_id, volume in active.items():
+            try:
+                next_step = STEPS[volume["step"]](
+                    ec2_client, volume_id, volume, resources, save
+                )
+            except (botocore.exceptions.ClientError, RemediationError) as e:
+                volume["error"] = str(e)
+                print(
+                    f"Error remediating volume {volume_id} at step {volume['step']}: {e}"
+                )
+                next_step = None
+            if next_step:
+                volume["step"] = next_step
+                print(f"Volume {volume_id}: {next_step}")
+            # Persist after every step so a crash never repeats finished work
+            if next_step or "error" in volume:
+                save()
+
+        restart_instances(ec2_client, state)
+        save()
+        time.sleep(poll_interval)
+
+    blocked = restart_instances(ec2_client, state)
+    save()
+    steps = [volume["step"] for volume in state["volumes"].values()]
+    failed = sum("error" in volume for volume in state["volumes"].values())
+    print(f"Remediated: {steps.count('remediated')}, Failed: {failed}")
+    stopped = [
+        instance_id
+        for instance_id, instance in state["instances"].items()
+        if instance["was_running"] and not instance.get("restarted")
+    ]
+    if stopped:
+        print("Instances left stopped:")
+        for instance_id in stopped:
+            reason = blocked.get(instance_id, "volumes still to be retried")
+            print(f"{instance_id} ({reason})")
+
+
+def main(file_path, workers):
+    # Create a session using your AWS credentials
+    session = boto3.Session()
+
+    # Create an EC2 client object using the defined session
+    ec2_client = session.client("ec2")
+
+    # Read the volume IDs from the text file
+    with open(file_path) as file:
+        volume_ids = [line.strip() for line in file if line.strip()]
+
+    # Only delete listed volumes that are available, not encrypted and have the 'remediated' tag
+    remediated_volume_ids = get_remediated_volume_ids(ec2_client)
+    to_delete = [v for v in volume_ids if v in remediated_volume_ids]
+    skipped = len(volume_ids) - len(to_delete)
+
+    deleted = 0
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(delete_volume, ec2_client, volume_id): volume_id
+            for volume_id in to_delete
+        }
+        for future in concurrent.futures.as_completed(futures):
+            volume_id = futures[future]
+            error = future.result()
+            if error:
+                failed += 1
+                print(f"Error deleting volume: {volume_id}. Error: {error}")
+            else:
+                deleted += 1
+                print(f"Deleted volume: {volume_id}")
+
+    print(f"Deleted: {deleted}, Skipped: {skipped}, Failed: {failed}")
+
+
+if __name__ == "__main__":
+    # Define argument parser
+    parser = argparse.ArgumentParser(
+        description="Delete or remediate specific unencrypted AWS EBS volumes."
+    )
+    parser.add_argument("file", help="Text file with volume IDs, one per line.")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=10,
+        help="Number of concurrent delete requests (default: 10).",
+    )
+    parser.add_argument(
+        "--remediate",
+        action="store_true",
+        help="Replace the listed unencrypted volumes with encrypted copies and tag the old ones 'remediated' instead of deleting.",
+    )
+    parser.add_argument(
+        "--state-file",
+        help="Remediation state file used to resume after a crash (default: <file>.state.json).",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=50,
+        help="Maximum number of volumes being remediated at once (default: 50).",
+    )
+    parser.add_argument(
+        "--kms-key-id",
+        help="KMS key for the encrypted copies (default: account EBS key).",
+    )
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    if args.remediate:
+        remediate_volumes(
+            args.file,
+            args.state_file or f"{args.file}.state.json",
+            args.max_in_flight,
+            args.kms_key_id,
+        )
+    else:
+        main(args.file, args.workers)
@@ -1,15 +1,90 @@
 import argparse
+import concurrent.futures
+import os
+import random
+import threading
+import time
 
 import boto3
+import botocore.exceptions
 
-# Create an EC2 resource object using the AWS SDK
-ec2_resource = boto3.resource("ec2")
+# Create an EC2 client object using the AWS SDK
+ec2_client = boto3.client("ec2")
 
+# Journal statuses that mean the snapshot needs no further work on a resumed run
+DONE_STATUSES = {"deleted", "not-found"}
 
-def delete_snapshots_from_file(file_path):
+
+# Caps in-flight deletes, halving the limit on throttling and growing it back on success
+class AdaptiveLimiter:
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.limit = float(max_workers)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def __exit__(self, *exc):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def throttled(self):
+        with self.condition:
+            self.limit = max(1.0, self.limit / 2)
+
+    def succeeded(self):
+        with self.condition:
+            self.limit = min(self.max_workers, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+def delete_snapshot(snapshot_id, limiter, max_attempts=8):
+    for attempt in range(max_attempts):
+        with limiter:
+            try:
+                ec2_client.delete_snapshot(SnapshotId=snapshot_id)
+                limiter.succeeded()
+                return "deleted", None
+            except botocore.exceptions.ClientError as e:
+                code = e.response["Error"]["Code"]
+                if code == "InvalidSnapshot.InUse":
+                    return "in-use", str(e)
+                if code == "InvalidSnapshot.NotFound":
+                    return "not-found", str(e)
+                if code != "RequestLimitExceeded":
+                    return "error", str(e)
+                limiter.throttled()
+        # Back off outside the limiter so the slot is free for other workers
+        time.sleep(min(2**attempt, 30) + random.uniform(0, 1))
+    return "error", "Request limit exceeded, giving up after retries"
+
+
+def read_journal(journal_path):
+    statuses = {}
+    if os.path.exists(journal_path):
+        with open(journal_path) as journal:
+            for line in journal:
+                snapshot_id, _, status = line.rstrip("\n").partition("\t")
+                statuses[snapshot_id] = status
+    return statuses
+
+
+def delete_snapshots_from_file(file_path, journal_path, batch_size, workers):
     # Read snapshot IDs from the provided file
     with open(file_path) as file:
-        snapshot_ids = file.read().splitlines()
+        snapshot_ids = [line.strip() for line in file if line.strip()]
+
+    # Skip everything an earlier, interrupted run already finished
+    journaled = read_journal(journal_path)
+    snapshot_ids = [s for s in snapshot_ids if journaled.get(s) not in DONE_STATUSES]
+    if journaled:
+        print(f"Resuming from journal {journal_path}.")
 
     initial_confirm = input(
         f"WARNING: You are about to delete {len(snapshot_ids)} snapshots. This action cannot be undone. Do you want to proceed? (y/n): "
@@ -18,21 +93,38 @@ def delete_snapshots_from_file(file_path):
         print("Exiting without deleting any snapshots.")
         return
 
-    for i, snapshot_id in enumerate(snapshot_ids, start=1):
-        try:
-            # Every 10 snapshots, ask for confirmation
-            if i % 10 == 0:
+    limiter = AdaptiveLimiter(workers)
+    counts = dict.fromkeys(["deleted", "in-use", "not-found", "error"], 0)
+    with open(journal_path, "a") as journal, concurrent.futures.ThreadPoolExecutor(
+        max_workers=workers
+    ) as executor:
+        for start in range(0, len(snapshot_ids), batch_size):
+            batch = snapshot_ids[start : start + batch_size]
+            # Ask for confirmation before every batch after the first
+            if start > 0:
                 confirm = input(
-                    f"You're about to delete the 10th snapshot ({snapshot_id}), do you want to continue? (y/n): "
+                    f"Processed {start} of {len(snapshot_ids)} snapshots. Delete the next {len(batch)}? (y/n): "
                 )
                 if confirm.lower() != "y":
-                    print("Exiting without deleting the snapshot.")
-                    return
-            snapshot = ec2_resource.Snapshot(snapshot_id)
-            snapshot.delete()
-            print(f"Deleted snapshot: {snapshot_id}")
-        except Exception as e:
-            print(f"Error deleting snapshot: {snapshot_id}. Error: {str(e)}")
+                    print("Stopping. Run again with the same journal to resume.")
+                    break
+
+            futures = {
+                executor.submit(delete_snapshot, snapshot_id, limiter): snapshot_id
+                for snapshot_id in batch
+            }
+            for future in concurrent.futures.as_completed(futures):
+                snapshot_id = futures[future]
+                status, error = future.result()
+                counts[status] += 1
+                journal.write(f"{snapshot_id}\t{status}\n")
+                journal.flush()
+                if error:
+                    print(f"Error deleting snapshot: {snapshot_id}. Error: {error}")
+                else:
+                    print(f"Deleted snapshot: {snapshot_id}")
+
+    print(", ".join(f"{status}: {count}" for status, count in counts.items()))
 
 
 if __name__ == "__main__":
@@ -40,6 +132,27 @@ if __name__ == "__main__":
     parser.add_argument(
         "file_path", help="Path to the file containing the list of Snapshot IDs"
     )
+    parser.add_argument(
+        "--journal",
+        help="Append-only journal used to resume an interrupted run (default: <file_path>.journal)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=500,
+        help="Number of snapshots to delete between confirmations (default: 500)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=10,
+        help="Maximum number of concurrent delete requests (default: 10)",
+    )
     args = parser.parse_args()
 
-    delete_snapshots_from_file(args.file_path)
+    delete_snapshots_from_file(
+        args.file_path,
+        args.journal or f"{args.file_path}.journal",
+        args.batch_size,
+        args.workers,
+    )
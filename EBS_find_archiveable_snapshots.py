@@ -1,96 +1,400 @@
 import argparse
+import concurrent.futures
+import random
+import time
+from collections import Counter
+from collections import defaultdict
 
 import boto3
+import botocore.exceptions
+import numpy as np
 
 # Initialize a session using your credentials
 session = boto3.Session()
 
-# Initialize the EC2 client
+# Initialize the EC2 and AWS Backup clients
 ec2 = session.client("ec2")
+backup = session.client("backup")
 
 
-# Function to check if snapshot is associated with an AMI
-def is_snapshot_associated_with_ami(snapshot_id):
-    images = ec2.describe_images(
-        Owners=["self"],
-        Filters=[{"Name": "block-device-mapping.snapshot-id", "Values": [snapshot_id]}],
-    )
-    return len(images["Images"]) > 0
-
+# Build a set of every snapshot referenced by one of our AMIs, listing images once
+def get_ami_snapshot_ids():
+    ami_snapshot_ids = set()
+    api_calls = 0
+    paginator = ec2.get_paginator("describe_images")
+    for page in paginator.paginate(Owners=["self"]):
+        api_calls += 1
+        for image in page["Images"]:
+            for mapping in image.get("BlockDeviceMappings", []):
+                snapshot_id = mapping.get("Ebs", {}).get("SnapshotId")
+                if snapshot_id:
+                    ami_snapshot_ids.add(snapshot_id)
+    return ami_snapshot_ids, api_calls
 
-def main(verbose, archivable_only):
-    # Retrieve the list of snapshots
-    snapshots = ec2.describe_snapshots(OwnerIds=["self"])
 
-    # Counters
-    archivable_count = 0
-    aws_backup_count = 0
-    ami_count = 0
-    not_completed_count = 0
-    root_device_ami_count = 0
+# Stream our snapshots page by page so large accounts are never truncated
+def iter_snapshots(api_calls):
+    paginator = ec2.get_paginator("describe_snapshots")
+    for page in paginator.paginate(OwnerIds=["self"]):
+        api_calls["describe_snapshots"] += 1
+        yield from page["Snapshots"]
 
-    # List to store eligible snapshots for archiving
-    archivable_snapshots = []
 
-    # Iterate through each snapshot
-    for snapshot in snapshots["Snapshots"]:
+# Apply the archiving rules to each snapshot as it arrives
+def classify_snapshots(snapshots, ami_snapshot_ids):
+    for snapshot in snapshots:
         snapshot_id = snapshot["SnapshotId"]
+        rules = {
+            # Rule 1: Check if the snapshot is in the 'completed' state
+            "not_completed": snapshot["State"] != "completed",
+            # Rule 2: Skip snapshots of root device volume of registered AMI
+            "root_device_ami": snapshot.get("Description", "").startswith(
+                "Created by CreateImage"
+            ),
+            # Rule 3: Check if snapshot is associated with an AMI
+            "ami": snapshot_id in ami_snapshot_ids,
+            # Rule 4: Check if snapshot is created by AWS Backup
+            "aws_backup": any(
+                tag.get("Key").startswith("aws:backup:")
+                for tag in snapshot.get("Tags", [])
+            ),
+        }
+        yield snapshot_id, rules, not any(rules.values())
+
+
+RULE_MESSAGES = {
+    "not_completed": "is not in the 'completed' state.",
+    "root_device_ami": "is of the root device volume of a registered AMI.",
+    "ami": "is associated with an EBS-backed AMI.",
+    "aws_backup": "was created by AWS Backup.",
+}
+
+
+# Update the counters for each classified snapshot and pass on the archivable IDs
+def filter_archivable(classified, counts, verbose):
+    for snapshot_id, rules, archivable in classified:
+        counts["total"] += 1
+        for rule, matched in rules.items():
+            if matched:
+                counts[rule] += 1
+                if verbose:
+                    print(f"Snapshot {snapshot_id} {RULE_MESSAGES[rule]}")
+
+        if archivable:
+            counts["archivable"] += 1
+            yield snapshot_id
+
 
-        # Rule 1: Check if the snapshot is in the 'completed' state
-        if snapshot["State"] != "completed":
-            if verbose and not archivable_only:
-                print(f"Snapshot {snapshot_id} is not in the 'completed' state.")
-            not_completed_count += 1
-
-        # Rule 2: Skip snapshots of root device volume of registered AMI
-        if snapshot.get("Description", "").startswith("Created by CreateImage"):
-            if verbose and not archivable_only:
-                print(
-                    f"Snapshot {snapshot_id} is of the root device volume of a registered AMI."
+# Move a single snapshot to the archive tier, backing off while throttled
+def archive_snapshot(snapshot_id, max_attempts=8):
+    for attempt in range(max_attempts):
+        try:
+            ec2.modify_snapshot_tier(SnapshotId=snapshot_id, StorageTier="archive")
+            return None
+        except botocore.exceptions.ClientError as e:
+            throttled = e.response["Error"]["Code"] == "RequestLimitExceeded"
+            if not throttled or attempt == max_attempts - 1:
+                return str(e)
+            time.sleep(min(2**attempt, 30) + random.uniform(0, 1))
+
+
+# Archive snapshots through a bounded worker pool as their IDs arrive
+def archive_snapshots(snapshot_ids, workers):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        for snapshot_id in snapshot_ids:
+            # Keep the queue bounded so IDs are not all buffered ahead of the workers
+            if len(pending) >= workers * 2:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
                 )
-            root_device_ami_count += 1
+                for future in done:
+                    yield pending.pop(future), future.result()
+            pending[executor.submit(archive_snapshot, snapshot_id)] = snapshot_id
+
+        for future in concurrent.futures.as_completed(pending):
+            yield pending[future], future.result()
 
-        # Rule 3: Check if snapshot is associated with an AMI
-        if is_snapshot_associated_with_ami(snapshot_id):
-            if verbose and not archivable_only:
-                print(f"Snapshot {snapshot_id} is associated with an EBS-backed AMI.")
-            ami_count += 1
 
-        # Rule 4: Check if snapshot is created by AWS Backup
-        if any(
-            tag.get("Key").startswith("aws:backup:") for tag in snapshot.get("Tags", [])
+# Look up the tiering status of the given snapshots, in batches of filter values
+def get_tier_statuses(snapshot_ids, batch_size=200):
+    statuses = {}
+    paginator = ec2.get_paginator("describe_snapshot_tier_status")
+    for i in range(0, len(snapshot_ids), batch_size):
+        batch = snapshot_ids[i : i + batch_size]
+        for page in paginator.paginate(
+            Filters=[{"Name": "snapshot-id", "Values": batch}]
         ):
-            if verbose and not archivable_only:
-                print(f"Snapshot {snapshot_id} was created by AWS Backup.")
-            aws_backup_count += 1
+            for status in page["SnapshotTierStatuses"]:
+                statuses[status["SnapshotId"]] = status.get(
+                    "LastTieringOperationStatus", "unknown"
+                )
+    return statuses
+
+
+def report_archive_progress(snapshot_ids, wait, poll_interval=60):
+    while True:
+        statuses = Counter(get_tier_statuses(snapshot_ids).values())
+        print(
+            "Archive status: "
+            + ", ".join(f"{status}: {count}" for status, count in statuses.items())
+        )
+        if not wait or statuses["archival-in-progress"] == 0:
+            return
+        time.sleep(poll_interval)
+
+
+def get_volume_ids():
+    paginator = ec2.get_paginator("describe_volumes")
+    return set(paginator.paginate().search("Volumes[].VolumeId"))
 
-        # Update counts based on whether the snapshot is archivable or not
+
+# Snapshots held as EBS recovery points in any of our backup vaults
+def get_backup_snapshot_ids():
+    snapshot_ids = set()
+    vault_paginator = backup.get_paginator("list_backup_vaults")
+    point_paginator = backup.get_paginator("list_recovery_points_by_backup_vault")
+    for vault_name in vault_paginator.paginate().search(
+        "BackupVaultList[].BackupVaultName"
+    ):
+        for arn in point_paginator.paginate(
+            BackupVaultName=vault_name, ByResourceType="EBS"
+        ).search("RecoveryPoints[].RecoveryPointArn"):
+            # EBS recovery point ARNs end in snapshot/snap-...
+            snapshot_ids.add(arn.rsplit("/", 1)[-1])
+    return snapshot_ids
+
+
+# Snapshots whose source volume is gone and that no AMI or recovery point uses
+def find_orphaned_snapshots(verbose):
+    api_calls = Counter()
+    existing_volume_ids = get_volume_ids()
+    ami_snapshot_ids, _ = get_ami_snapshot_ids()
+    referenced_ids = ami_snapshot_ids | get_backup_snapshot_ids()
+
+    source_volumes = {
+        snapshot["SnapshotId"]: snapshot.get("VolumeId")
+        for snapshot in iter_snapshots(api_calls)
+    }
+    # Copied snapshots all report the placeholder volume vol-ffffffff, so
+    # their source cannot be checked and they get their own category
+    copied_ids = {
+        snapshot_id
+        for snapshot_id, volume_id in source_volumes.items()
+        if volume_id == "vol-ffffffff"
+    }
+    volumeless_ids = {
+        snapshot_id
+        for snapshot_id, volume_id in source_volumes.items()
+        if volume_id not in existing_volume_ids
+    } - copied_ids
+    orphaned_ids = volumeless_ids - referenced_ids
+    unreferenced_copy_ids = copied_ids - referenced_ids
+
+    print("Orphaned snapshots:")
+    for snapshot_id in sorted(orphaned_ids):
+        if verbose:
+            print(f"{snapshot_id} (source volume {source_volumes[snapshot_id]})")
+        else:
+            print(snapshot_id)
+    if verbose:
+        print("Copied snapshots not used by an AMI or AWS Backup:")
+        for snapshot_id in sorted(unreferenced_copy_ids):
+            print(snapshot_id)
+    print(f"Total snapshots in the account: {len(source_volumes)}")
+    print(f"Snapshots whose source volume no longer exists: {len(volumeless_ids)}")
+    print(f"Orphaned snapshots not used by an AMI or AWS Backup: {len(orphaned_ids)}")
+    print(
+        f"Copied snapshots (source volume unknown): {len(copied_ids)}, "
+        f"not used by an AMI or AWS Backup: {len(unreferenced_copy_ids)}"
+    )
+
+
+# Block indexes that differ between two snapshots, or all blocks of one snapshot,
+# as a sorted int64 array; a full 16 TiB volume is 32M blocks
+def list_changed_block_indexes(ebs_client, second_snapshot_id, first_snapshot_id=None):
+    if first_snapshot_id:
+        call = ebs_client.list_changed_blocks
+        kwargs = {
+            "FirstSnapshotId": first_snapshot_id,
+            "SecondSnapshotId": second_snapshot_id,
+        }
+        blocks_key = "ChangedBlocks"
+    else:
+        call = ebs_client.list_snapshot_blocks
+        kwargs = {"SnapshotId": second_snapshot_id}
+        blocks_key = "Blocks"
+    kwargs["MaxResults"] = 10000
+
+    pages = []
+    block_size = 0
+    while True:
+        response = call(**kwargs)
+        block_size = response.get("BlockSize", block_size)
+        pages.append(
+            np.fromiter(
+                (block["BlockIndex"] for block in response[blocks_key]),
+                dtype=np.int64,
+                count=len(response[blocks_key]),
+            )
+        )
+        if not response.get("NextToken"):
+            return np.unique(np.concatenate(pages)), block_size
+        kwargs["NextToken"] = response["NextToken"]
+
+
+# Completed snapshots grouped by source volume, oldest first
+def get_snapshot_chains(snapshots):
+    chains = defaultdict(list)
+    for snapshot in snapshots:
+        # Copied snapshots all report the placeholder volume vol-ffffffff, and
+        # the EBS direct APIs cannot read archived snapshots
         if (
             snapshot["State"] == "completed"
-            and not snapshot.get("Description", "").startswith("Created by CreateImage")
-            and not is_snapshot_associated_with_ami(snapshot_id)
-            and not any(
-                tag.get("Key").startswith("aws:backup:")
-                for tag in snapshot.get("Tags", [])
-            )
+            and snapshot["VolumeId"] != "vol-ffffffff"
+            and snapshot.get("StorageTier", "standard") == "standard"
         ):
-            archivable_count += 1
-            archivable_snapshots.append(snapshot_id)
+            chains[snapshot["VolumeId"]].append(
+                (snapshot["StartTime"], snapshot["SnapshotId"])
+            )
+    return {
+        volume_id: [snapshot_id for _, snapshot_id in sorted(chain)]
+        for volume_id, chain in chains.items()
+    }
+
+
+# Blocks a snapshot wrote relative to the one before it, or None if the
+# comparison failed
+def get_written_blocks(ebs_client, chain, i):
+    first_snapshot_id = chain[i - 1] if i else None
+    try:
+        return list_changed_block_indexes(ebs_client, chain[i], first_snapshot_id)
+    except botocore.exceptions.ClientError as e:
+        print(f"Error comparing {first_snapshot_id} and {chain[i]}: {e}")
+        return None
+
+
+# Walk one chain holding only the written blocks of two adjacent snapshots,
+# returning (snapshot, incremental bytes, unique bytes) with None where unknown
+def estimate_one_chain(ebs_client, chain):
+    estimates = []
+    written = get_written_blocks(ebs_client, chain, 0)
+    for i, snapshot_id in enumerate(chain):
+        next_written = None
+        if i + 1 < len(chain):
+            next_written = get_written_blocks(ebs_client, chain, i + 1)
+        if written is None:
+            estimates.append((snapshot_id, None, None))
+        else:
+            blocks, block_size = written
+            # A written block stays unique to this snapshot only if the next
+            # snapshot overwrote it; otherwise the next one shares it
+            if i + 1 == len(chain):
+                unique_bytes = blocks.size * block_size
+            elif next_written is None:
+                unique_bytes = None
+            else:
+                overwritten = np.intersect1d(
+                    blocks, next_written[0], assume_unique=True
+                )
+                unique_bytes = overwritten.size * block_size
+            estimates.append((snapshot_id, blocks.size * block_size, unique_bytes))
+        written = next_written
+    return estimates
+
+
+# Estimate each snapshot's incremental and unique bytes, one chain per worker
+def estimate_chain_bytes(ebs_client, chains, workers):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(estimate_one_chain, ebs_client, chain): volume_id
+            for volume_id, chain in chains.items()
+        }
+        return {
+            futures[future]: future.result()
+            for future in concurrent.futures.as_completed(futures)
+        }
+
+
+def report_lineage(workers, ebs_client=None):
+    ebs_client = ebs_client or session.client("ebs")
+    chains = get_snapshot_chains(iter_snapshots(Counter()))
+    estimates = estimate_chain_bytes(ebs_client, chains, workers)
+
+    def gib(size):
+        return "error" if size is None else f"{size / 1024**3:.2f}"
+
+    print("Volume ID, Snapshot ID, Incremental GiB, Unique GiB")
+    for volume_id, snapshots in estimates.items():
+        for snapshot_id, incremental, unique in snapshots:
+            print(f"{volume_id}, {snapshot_id}, {gib(incremental)}, {gib(unique)}")
+        # Snapshots that could not be compared are left out of the total
+        chain_total = sum(incremental or 0 for _, incremental, _ in snapshots)
+        print(f"{volume_id}, chain total, {gib(chain_total)}, -")
+
+
+def main(verbose, archivable_only, archive=False, workers=10, wait=False):
+    api_calls = {"describe_snapshots": 0, "describe_images": 0}
+
+    # Index AMI snapshots once instead of one describe_images call per snapshot
+    ami_snapshot_ids, api_calls["describe_images"] = get_ami_snapshot_ids()
+
+    # Counters
+    counts = Counter()
+
+    if archive:
+        confirm = input(
+            "WARNING: You are about to move every snapshot eligible for archiving to the archive tier. Do you want to proceed? (y/n): "
+        )
+        if confirm.lower() != "y":
+            print("Exiting without archiving any snapshots.")
+            return
+
+    # Only counters are kept; archivable IDs are emitted as soon as they are classified
+    classified = classify_snapshots(iter_snapshots(api_calls), ami_snapshot_ids)
+    archivable_ids = filter_archivable(
+        classified, counts, verbose and not archivable_only
+    )
+
+    if archive:
+        archived_ids = []
+        failed_count = 0
+        for snapshot_id, error in archive_snapshots(archivable_ids, workers):
+            if error:
+                failed_count += 1
+                print(f"Error archiving snapshot: {snapshot_id}. Error: {error}")
+            else:
+                archived_ids.append(snapshot_id)
+                if verbose:
+                    print(f"Archiving snapshot: {snapshot_id}")
+        print(f"Snapshots submitted for archiving: {len(archived_ids)}")
+        print(f"Snapshots that failed to archive: {failed_count}")
+        if archived_ids:
+            report_archive_progress(archived_ids, wait)
+        return
 
-    # Print the results
     if archivable_only:
         print("Snapshots eligible for archiving:")
-        for snap_id in archivable_snapshots:
-            print(snap_id)
-    else:
-        print(f"Total snapshots in the account: {len(snapshots['Snapshots'])}")
-        print(f"Snapshots available to be archived: {archivable_count}")
-        print(f"Snapshots not in 'completed' state: {not_completed_count}")
+    for snapshot_id in archivable_ids:
+        if archivable_only:
+            print(snapshot_id, flush=True)
+
+    # Print the results
+    if not archivable_only:
+        print(f"Total snapshots in the account: {counts['total']}")
+        print(f"Snapshots available to be archived: {counts['archivable']}")
+        print(f"Snapshots not in 'completed' state: {counts['not_completed']}")
+        print(
+            f"Snapshots of root device volume of registered AMI: {counts['root_device_ami']}"
+        )
+        print(f"Snapshots that are part of AWS backups: {counts['aws_backup']}")
+        print(f"Snapshots that are part of an AMI: {counts['ami']}")
+        # The snapshot listing plus the AMI index, versus two describe_images
+        # calls per snapshot with the old per-snapshot lookup
+        print(f"API calls made: {sum(api_calls.values())}")
         print(
-            f"Snapshots of root device volume of registered AMI: {root_device_ami_count}"
+            f"API calls with per-snapshot AMI lookups: {api_calls['describe_snapshots'] + 2 * counts['total']}"
         )
-        print(f"Snapshots that are part of AWS backups: {aws_backup_count}")
-        print(f"Snapshots that are part of an AMI: {ami_count}")
 
 
 if __name__ == "__main__":
@@ -109,7 +413,38 @@ if __name__ == "__main__":
         action="store_true",
         help="Print only the IDs of snapshots eligible for archiving",
     )
+    parser.add_argument(
+        "--archive",
+        action="store_true",
+        help="Move every snapshot eligible for archiving to the archive tier",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=10,
+        help="Number of concurrent archive or EBS direct API requests (default: 10)",
+    )
+    parser.add_argument(
+        "--wait",
+        action="store_true",
+        help="With --archive, poll until no snapshot is still being archived",
+    )
+    parser.add_argument(
+        "--orphaned",
+        action="store_true",
+        help="Find snapshots whose source volume is gone and that no AMI or AWS Backup recovery point uses",
+    )
+    parser.add_argument(
+        "--lineage",
+        action="store_true",
+        help="Estimate incremental and unique bytes per snapshot and per volume chain with the EBS direct APIs",
+    )
     args = parser.parse_args()
 
-    # Execute the main function with the verbose and archivable_only flags
-    main(args.verbose, args.archivable_only)
+    if args.orphaned:
+        find_orphaned_snapshots(args.verbose)
+    elif args.lineage:
+        report_lineage(args.workers)
+    else:
+        # Execute the main function with the verbose and archivable_only flags
+        main(args.verbose, args.archivable_only, args.archive, args.workers, args.wait)
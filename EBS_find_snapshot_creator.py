@@ -1,8 +1,15 @@
 import argparse
+import concurrent.futures
+import gzip
 import json
+import os
+import re
+import sqlite3
 import time
+from datetime import timedelta
 
 import boto3
+import botocore.exceptions
 
 
 def get_snapshot_info(snapshot_ids):
@@ -37,13 +44,244 @@ def get_snapshot_info(snapshot_ids):
             time.sleep(0.5)  # sleep for 500 milliseconds
 
 
-# Parse command line arguments
-parser = argparse.ArgumentParser(description="Process snapshot file.")
-parser.add_argument("filename", help="The name of the file containing snapshot IDs.")
-args = parser.parse_args()
+# Errors caused by a bad ID in the batch rather than by the request itself
+INVALID_ID_ERRORS = {"InvalidSnapshot.NotFound", "InvalidSnapshotID.Malformed"}
 
-# Read snapshot IDs from a file
-with open(args.filename) as file:
-    snapshot_ids = [line.strip() for line in file]
 
-get_snapshot_info(snapshot_ids)
+# Describe a batch of snapshots, splitting it to isolate any missing or invalid IDs
+def describe_snapshot_batch(paginator, snapshot_ids):
+    try:
+        snapshots = []
+        for page in paginator.paginate(SnapshotIds=snapshot_ids):
+            snapshots.extend(page["Snapshots"])
+        return snapshots, {}
+    except botocore.exceptions.ClientError as e:
+        code = e.response["Error"]["Code"]
+        if code not in INVALID_ID_ERRORS:
+            raise
+        if len(snapshot_ids) == 1:
+            return [], {snapshot_ids[0]: code}
+
+    middle = len(snapshot_ids) // 2
+    snapshots, errors = describe_snapshot_batch(paginator, snapshot_ids[:middle])
+    more_snapshots, more_errors = describe_snapshot_batch(
+        paginator, snapshot_ids[middle:]
+    )
+    return snapshots + more_snapshots, errors | more_errors
+
+
+# Describe the snapshots in batches instead of one call per ID
+def describe_snapshots_in_batches(ec2_client, snapshot_ids, batch_size=200):
+    snapshots = []
+    paginator = ec2_client.get_paginator("describe_snapshots")
+    for i in range(0, len(snapshot_ids), batch_size):
+        found, errors = describe_snapshot_batch(
+            paginator, snapshot_ids[i : i + batch_size]
+        )
+        snapshots.extend(found)
+        for snapshot_id, code in errors.items():
+            print(f"Snapshot ID: {snapshot_id}, Error: {code}")
+    return snapshots
+
+
+# Map snapshot IDs to creators from every CreateSnapshot event in the time window
+def get_snapshot_creators(cloudtrail_client, start_time, end_time):
+    creators = {}
+    paginator = cloudtrail_client.get_paginator("lookup_events")
+
+    for page in paginator.paginate(
+        LookupAttributes=[
+            {"AttributeKey": "EventName", "AttributeValue": "CreateSnapshot"},
+        ],
+        StartTime=start_time,
+        EndTime=end_time,
+    ):
+        for event in page["Events"]:
+            event_dict = json.loads(event["CloudTrailEvent"])
+            snapshot_id = (event_dict.get("responseElements") or {}).get("snapshotId")
+            if snapshot_id:
+                creators[snapshot_id] = event_dict["userIdentity"].get("arn")
+    return creators
+
+
+def get_snapshot_info_bulk(snapshot_ids):
+    ec2_client = boto3.client("ec2")
+    cloudtrail_client = boto3.client("cloudtrail")
+
+    snapshots = describe_snapshots_in_batches(ec2_client, snapshot_ids)
+    if not snapshots:
+        return
+
+    # The CreateSnapshot event is recorded when the snapshot starts, so pad the
+    # window slightly to catch events logged just before StartTime
+    start_times = [snapshot["StartTime"] for snapshot in snapshots]
+    creators = get_snapshot_creators(
+        cloudtrail_client,
+        min(start_times) - timedelta(minutes=15),
+        max(start_times) + timedelta(minutes=15),
+    )
+
+    for snapshot in snapshots:
+        print(f"Snapshot ID: {snapshot['SnapshotId']}")
+        print(f"Started on: {snapshot['StartTime']}")
+        print(f"Description: {snapshot['Description']}")
+        if snapshot["SnapshotId"] in creators:
+            print(f"Created by: {creators[snapshot['SnapshotId']]}")
+        print()
+
+
+# Events that can tell us who created a snapshot, directly or through its AMI
+CREATOR_EVENTS = {"CreateSnapshot", "CopySnapshot", "CreateImage"}
+DEFAULT_INDEX_FILE = "snapshot_creator_index.db"
+
+
+# Decompress and parse one CloudTrail log file, keeping only creator events.
+# Returns the error instead of raising so one bad file cannot stop the scan.
+def parse_cloudtrail_file(path):
+    try:
+        with gzip.open(path, "rt") as f:
+            log = json.load(f)
+    except (OSError, EOFError, ValueError) as e:
+        return path, [], str(e)
+
+    records = []
+    for record in log.get("Records", []):
+        if record.get("eventName") not in CREATOR_EVENTS:
+            continue
+        response = record.get("responseElements") or {}
+        resource_id = response.get("snapshotId") or response.get("imageId")
+        if resource_id:
+            records.append(
+                (
+                    resource_id,
+                    record.get("userIdentity", {}).get("arn"),
+                    record["eventName"],
+                    record.get("eventTime"),
+                )
+            )
+    return path, records, None
+
+
+def open_creator_index(index_file):
+    conn = sqlite3.connect(index_file)
+    conn.execute("CREATE TABLE IF NOT EXISTS scanned_files (path TEXT PRIMARY KEY)")
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS creators (
+            resource_id TEXT PRIMARY KEY,
+            arn TEXT,
+            event_name TEXT,
+            event_time TEXT
+        )"""
+    )
+    return conn
+
+
+# Scan a local copy of the trail bucket, skipping files already in the index.
+# Results are written every batch_size files, so an interrupted scan keeps its
+# progress and each write only adds the new rows.
+def scan_cloudtrail_archive(cloudtrail_dir, conn, batch_size=1000):
+    scanned_files = {row[0] for row in conn.execute("SELECT path FROM scanned_files")}
+    paths = [
+        os.path.join(root, name)
+        for root, _, names in os.walk(cloudtrail_dir)
+        for name in names
+        if name.endswith(".json.gz") and os.path.join(root, name) not in scanned_files
+    ]
+    print(f"Scanning {len(paths)} new CloudTrail log files...")
+
+    def write_batch(creator_rows, scanned_rows):
+        conn.executemany(
+            "INSERT OR REPLACE INTO creators VALUES (?, ?, ?, ?)", creator_rows
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO scanned_files VALUES (?)", scanned_rows
+        )
+        conn.commit()
+
+    failed_paths = []
+    creator_rows = []
+    scanned_rows = []
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        results = executor.map(parse_cloudtrail_file, paths, chunksize=64)
+        for path, records, error in results:
+            if error:
+                # Not marked as scanned, so the next run tries the file again
+                print(f"Error reading {path}: {error}")
+                failed_paths.append(path)
+                continue
+            creator_rows.extend(records)
+            scanned_rows.append((path,))
+            if len(scanned_rows) == batch_size:
+                write_batch(creator_rows, scanned_rows)
+                creator_rows = []
+                scanned_rows = []
+    write_batch(creator_rows, scanned_rows)
+
+    if failed_paths:
+        print(f"Could not read {len(failed_paths)} CloudTrail log files:")
+        for path in failed_paths:
+            print(path)
+
+
+def get_creator(conn, resource_id):
+    return conn.execute(
+        "SELECT arn, event_name FROM creators WHERE resource_id = ?", (resource_id,)
+    ).fetchone()
+
+
+def get_snapshot_info_offline(snapshot_ids, cloudtrail_dir, index_file):
+    conn = open_creator_index(index_file)
+    if cloudtrail_dir:
+        scan_cloudtrail_archive(cloudtrail_dir, conn)
+
+    ec2_client = boto3.client("ec2")
+    for snapshot in describe_snapshots_in_batches(ec2_client, snapshot_ids):
+        print(f"Snapshot ID: {snapshot['SnapshotId']}")
+        print(f"Started on: {snapshot['StartTime']}")
+        print(f"Description: {snapshot['Description']}")
+
+        creator = get_creator(conn, snapshot["SnapshotId"])
+        # Snapshots taken by CreateImage are attributed to whoever created the AMI
+        ami_match = re.search(r"for (ami-[0-9a-f]+)", snapshot["Description"])
+        if not creator and ami_match:
+            creator = get_creator(conn, ami_match.group(1))
+        if creator:
+            arn, event_name = creator
+            print(f"Created by: {arn} ({event_name})")
+        print()
+    conn.close()
+
+
+if __name__ == "__main__":
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description="Process snapshot file.")
+    parser.add_argument(
+        "filename", help="The name of the file containing snapshot IDs."
+    )
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help="Describe snapshots in batches and look up creators with one CloudTrail query over their time window",
+    )
+    parser.add_argument(
+        "--cloudtrail-dir",
+        help="Local directory of gzipped CloudTrail logs (e.g. an 'aws s3 sync' of the trail bucket) to add to the creator index",
+    )
+    parser.add_argument(
+        "--index",
+        help=f"SQLite creator index to read and update instead of querying CloudTrail (default with --cloudtrail-dir: {DEFAULT_INDEX_FILE})",
+    )
+    args = parser.parse_args()
+
+    # Read snapshot IDs from a file
+    with open(args.filename) as file:
+        snapshot_ids = [line.strip() for line in file if line.strip()]
+
+    if args.cloudtrail_dir or args.index:
+        get_snapshot_info_offline(
+            snapshot_ids, args.cloudtrail_dir, args.index or DEFAULT_INDEX_FILE
+        )
+    elif args.bulk:
+        get_snapshot_info_bulk(snapshot_ids)
+    else:
+        get_snapshot_info(snapshot_ids)
@@ -1,4 +1,10 @@
 import argparse
+import concurrent.futures
+import sqlite3
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
 
 import boto3
 
@@ -8,29 +14,189 @@ python script_name.py --before 2022-01-01
 
 2. To get snapshots created after a specific date:
 python script_name.py --after 2022-01-01
+
+3. To sync a local snapshot catalog, then query it without calling AWS:
+python script_name.py --sync
+python script_name.py --catalog snapshot_catalog.db --after 2022-01-01 --before 2022-07-01
+
+4. To list a date range in parallel, one thread per month (or day) of the range:
+python script_name.py --after 2022-01-01 --before 2022-07-01 --shard month
 """
 
+DEFAULT_CATALOG_FILE = "snapshot_catalog.db"
+
+
+def parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+
 
 def get_all_snapshots(before_date, after_date):
     ec2_client = boto3.client("ec2")
     paginator = ec2_client.get_paginator("describe_snapshots")
     snapshot_ids = []
 
-    # Define filters based on provided dates
-    filters = []
-    if before_date:
-        filters.append({"Name": "start-time", "Values": [f"{before_date}T00:00:00Z"]})
+    # The start-time filter only matches exact values or wildcards, so the
+    # date range is applied to our own snapshots client-side
+    before = parse_date(before_date) if before_date else None
+    after = parse_date(after_date) if after_date else None
 
-    if after_date:
-        filters.append({"Name": "start-time", "Values": [f"{after_date}T00:00:00Z"]})
-
-    for page in paginator.paginate(Filters=filters):
+    for page in paginator.paginate(OwnerIds=["self"]):
         for snapshot in page["Snapshots"]:
+            if before and snapshot["StartTime"] >= before:
+                continue
+            if after and snapshot["StartTime"] < after:
+                continue
             snapshot_ids.append(snapshot["SnapshotId"])
 
     return snapshot_ids
 
 
+# Build one start-time wildcard per month or day covering [after, before)
+def get_shard_patterns(after, before, shard):
+    patterns = []
+    day = after
+    while day < before:
+        if shard == "day":
+            patterns.append(f"{day.isoformat()}*")
+            day += timedelta(days=1)
+        else:
+            patterns.append(f"{day.strftime('%Y-%m')}-*")
+            day = (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+    return patterns
+
+
+def list_shard(ec2_client, pattern):
+    paginator = ec2_client.get_paginator("describe_snapshots")
+    snapshots = []
+    for page in paginator.paginate(
+        OwnerIds=["self"], Filters=[{"Name": "start-time", "Values": [pattern]}]
+    ):
+        for snapshot in page["Snapshots"]:
+            snapshots.append((snapshot["StartTime"], snapshot["SnapshotId"]))
+    return sorted(snapshots)
+
+
+# Page through each time shard in its own thread and merge them in start-time order
+def get_snapshots_sharded(before_date, after_date, shard, workers):
+    ec2_client = boto3.client("ec2")
+    after = parse_date(after_date)
+    before = parse_date(before_date) if before_date else None
+    if before:
+        last_day = before.date()
+    else:
+        last_day = datetime.now(timezone.utc).date() + timedelta(days=1)
+    patterns = get_shard_patterns(after.date(), last_day, shard)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        # Shards cover consecutive time ranges, so results come back in order
+        # and each one can be emitted as soon as the shards before it are done
+        for snapshots in executor.map(
+            lambda pattern: list_shard(ec2_client, pattern), patterns
+        ):
+            for start_time, snapshot_id in snapshots:
+                if start_time < after or (before and start_time >= before):
+                    continue
+                yield snapshot_id
+
+
+def open_catalog(catalog_file):
+    conn = sqlite3.connect(catalog_file)
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS snapshots (
+            snapshot_id TEXT PRIMARY KEY,
+            start_time TEXT NOT NULL,
+            volume_id TEXT,
+            volume_size INTEGER,
+            state TEXT,
+            description TEXT
+        )"""
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS snapshots_start_time ON snapshots (start_time)"
+    )
+    return conn
+
+
+# Build start-time wildcards for every day from the high-water mark to today
+def get_day_patterns(since):
+    # StartTime is in UTC, so "today" has to be the UTC date too
+    today = datetime.now(timezone.utc).date()
+    day = since
+    patterns = []
+    while day <= today:
+        patterns.append(f"{day.isoformat()}*")
+        day += timedelta(days=1)
+    return patterns
+
+
+def sync_catalog(catalog_file, full_sync=False):
+    ec2_client = boto3.client("ec2")
+    paginator = ec2_client.get_paginator("describe_snapshots")
+    conn = open_catalog(catalog_file)
+
+    if full_sync:
+        conn.execute("DELETE FROM snapshots")
+    high_water_mark = conn.execute("SELECT MAX(start_time) FROM snapshots").fetchone()[
+        0
+    ]
+
+    # Only fetch snapshots from the high-water mark's day onwards; that day is
+    # listed again so snapshots that were still pending get their final state
+    if high_water_mark:
+        patterns = get_day_patterns(date.fromisoformat(high_water_mark[:10]))
+        filter_sets = [
+            [{"Name": "start-time", "Values": patterns[i : i + 200]}]
+            for i in range(0, len(patterns), 200)
+        ]
+    else:
+        filter_sets = [[]]
+
+    synced = 0
+    for filters in filter_sets:
+        for page in paginator.paginate(OwnerIds=["self"], Filters=filters):
+            rows = [
+                (
+                    snapshot["SnapshotId"],
+                    snapshot["StartTime"]
+                    .astimezone(timezone.utc)
+                    .strftime("%Y-%m-%dT%H:%M:%S"),
+                    snapshot.get("VolumeId"),
+                    snapshot.get("VolumeSize"),
+                    snapshot.get("State"),
+                    snapshot.get("Description"),
+                )
+                for snapshot in page["Snapshots"]
+            ]
+            conn.executemany(
+                "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+            conn.commit()
+            synced += len(rows)
+
+    conn.close()
+    print(f"Synced {synced} snapshots into {catalog_file}")
+
+
+def query_catalog(catalog_file, before_date, after_date):
+    conn = open_catalog(catalog_file)
+    conditions = []
+    params = []
+    if before_date:
+        conditions.append("start_time < ?")
+        params.append(before_date)
+    if after_date:
+        conditions.append("start_time >= ?")
+        params.append(after_date)
+
+    rows = conn.execute(
+        f"SELECT snapshot_id FROM snapshots WHERE {' AND '.join(conditions)} ORDER BY start_time",
+        params,
+    )
+    snapshot_ids = [row[0] for row in rows]
+    conn.close()
+    return snapshot_ids
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Filter AWS EBS snapshots based on dates."
@@ -45,14 +211,56 @@ def main():
         type=str,
         help="Fetch snapshots created after this date in the format YYYY-MM-DD.",
     )
+    parser.add_argument(
+        "--catalog",
+        type=str,
+        help=f"Answer date queries from this local SQLite catalog instead of AWS (default with --sync: {DEFAULT_CATALOG_FILE}).",
+    )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="Add snapshots newer than the catalog's latest start time to the catalog.",
+    )
+    parser.add_argument(
+        "--full-sync",
+        action="store_true",
+        help="Rebuild the catalog from a full listing, dropping deleted snapshots.",
+    )
+
+    parser.add_argument(
+        "--shard",
+        choices=["month", "day"],
+        help="List the --after/--before range in parallel, one thread per month or day.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="Number of shards listed concurrently with --shard (default: 8).",
+    )
 
     args = parser.parse_args()
+    catalog_file = args.catalog
+    if args.sync or args.full_sync:
+        catalog_file = catalog_file or DEFAULT_CATALOG_FILE
+        sync_catalog(catalog_file, args.full_sync)
 
     if not args.before and not args.after:
-        print("Please provide either --before or --after date.")
+        if not (args.sync or args.full_sync):
+            print("Please provide either --before or --after date.")
         return
 
-    snapshot_ids = get_all_snapshots(args.before, args.after)
+    if catalog_file:
+        snapshot_ids = query_catalog(catalog_file, args.before, args.after)
+    elif args.shard:
+        if not args.after:
+            print("Please provide an --after date to shard the listing.")
+            return
+        snapshot_ids = get_snapshots_sharded(
+            args.before, args.after, args.shard, args.workers
+        )
+    else:
+        snapshot_ids = get_all_snapshots(args.before, args.after)
 
     for snapshot_id in snapshot_ids:
         print(snapshot_id)
@@ -1,9 +1,14 @@
 import argparse
-import concurrent.futures
+import shlex
+import sys
+import time
+from collections import defaultdict
 from datetime import datetime
+from datetime import timedelta
 from datetime import timezone
 
 import boto3
+import numpy as np
 
 """
 1. **Using the `--start_date` argument**:
@@ -18,47 +23,179 @@ import boto3
 4. **Combining multiple arguments**:
    You can combine multiple arguments to refine your search:
    python EBS_list_filtered_snapshots.py --start_date 2020-01-01 --size 10 --description "Backup for Project X"
+5. **Running many queries against one listing**:
+   Load the snapshots once, then answer one query per line from a file (or stdin with "-"),
+   each line using the arguments above:
+   python EBS_list_filtered_snapshots.py --queries queries.txt
 """
 
 
 # Function to process a single snapshot
 def process_snapshot(snapshot, start_date, size, description):
-    creation_date = snapshot.start_time.replace(tzinfo=timezone.utc).astimezone(tz=None)
+    creation_date = snapshot["StartTime"].astimezone(timezone.utc)
 
-    # Filter by start date
+    # The server-side filters already match these; re-check them in case a
+    # wildcard matched more loosely than the original phrase
     if start_date and creation_date.date() < start_date:
-        return
-
-    # Filter by size
-    if size and snapshot.volume_size != size:
-        return
-
-    # Filter by description
-    if description and description not in snapshot.description:
-        return
+        return False
+    if size and snapshot["VolumeSize"] != size:
+        return False
+    if description and description not in snapshot.get("Description", ""):
+        return False
 
     print(
-        f"Snapshot ID: {snapshot.snapshot_id}, Started on: {snapshot.start_time}, Size: {snapshot.volume_size}GB, Description: {snapshot.description}"
+        f"Snapshot ID: {snapshot['SnapshotId']}, Started on: {snapshot['StartTime']}, Size: {snapshot['VolumeSize']}GB, Description: {snapshot.get('Description', '')}"
     )
+    return True
+
+
+# start-time only matches exact values or wildcards, so "on or after" becomes
+# one pattern per remaining day of the first month, then one per later month
+def get_start_time_patterns(start_date):
+    # StartTime is in UTC, so "today" has to be the UTC date too
+    today = datetime.now(timezone.utc).date()
+    patterns = []
+    day = start_date
+    while day.day != 1 and day <= today:
+        patterns.append(f"{day.isoformat()}*")
+        day += timedelta(days=1)
+    while day <= today:
+        patterns.append(f"{day.strftime('%Y-%m')}-*")
+        day = (day + timedelta(days=32)).replace(day=1)
+    return patterns
+
+
+def get_filter_sets(start_date, size, description):
+    filters = []
+    if size:
+        filters.append({"Name": "volume-size", "Values": [str(size)]})
+    if description:
+        escaped = description.replace("\\", "\\\\").replace("*", "\\*")
+        escaped = escaped.replace("?", "\\?")
+        filters.append({"Name": "description", "Values": [f"*{escaped}*"]})
+    if not start_date:
+        return [filters]
+
+    # A filter accepts at most 200 values, so long ranges take several listings
+    patterns = get_start_time_patterns(start_date)
+    return [
+        filters + [{"Name": "start-time", "Values": patterns[i : i + 200]}]
+        for i in range(0, len(patterns), 200)
+    ]
 
 
 # Function to filter and print snapshots
 def get_snapshots(start_date, size, description):
-    ec2 = boto3.resource("ec2")
-
-    print("Fetching all snapshots, please wait...")
-    snapshots = list(ec2.snapshots.all())
-
-    print(f"Processing {len(snapshots)} snapshots...")
-
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        executor.map(
-            process_snapshot,
-            snapshots,
-            [start_date] * len(snapshots),
-            [size] * len(snapshots),
-            [description] * len(snapshots),
-        )
+    ec2 = boto3.client("ec2")
+    paginator = ec2.get_paginator("describe_snapshots")
+
+    print("Fetching matching snapshots...")
+    matched = 0
+    for filters in get_filter_sets(start_date, size, description):
+        for page in paginator.paginate(OwnerIds=["self"], Filters=filters):
+            for snapshot in page["Snapshots"]:
+                if process_snapshot(snapshot, start_date, size, description):
+                    matched += 1
+
+    print(f"Found {matched} matching snapshots.")
+
+
+# Snapshots loaded once into NumPy columns so each query is a vectorized mask
+class SnapshotTable:
+    def __init__(self, snapshots):
+        ids = []
+        start_times = []
+        sizes = []
+        description_codes = []
+        codes = {}
+        for snapshot in snapshots:
+            ids.append(snapshot["SnapshotId"])
+            start_times.append(int(snapshot["StartTime"].timestamp()))
+            sizes.append(snapshot["VolumeSize"])
+            # Intern descriptions; most snapshots share a handful of them
+            description = snapshot.get("Description", "")
+            description_codes.append(codes.setdefault(description, len(codes)))
+
+        self.ids = np.array(ids, dtype=object)
+        self.start_times = np.array(start_times, dtype=np.int64)
+        self.sizes = np.array(sizes, dtype=np.int32)
+        self.description_codes = np.array(description_codes, dtype=np.int32)
+        self.descriptions = list(codes)
+
+        # Trigram -> codes of the unique descriptions that contain it
+        trigrams = defaultdict(set)
+        for code, text in enumerate(self.descriptions):
+            for i in range(len(text) - 2):
+                trigrams[text[i : i + 3]].add(code)
+        self.trigrams = {
+            trigram: np.fromiter(found, dtype=np.int32)
+            for trigram, found in trigrams.items()
+        }
+
+    @classmethod
+    def load(cls):
+        paginator = boto3.client("ec2").get_paginator("describe_snapshots")
+        pages = paginator.paginate(OwnerIds=["self"])
+        return cls(snapshot for page in pages for snapshot in page["Snapshots"])
+
+    def _description_mask(self, phrase):
+        # Narrow the unique descriptions down with the phrase's trigrams, then
+        # confirm the substring on the few candidates left
+        candidates = None
+        for i in range(len(phrase) - 2):
+            found = self.trigrams.get(phrase[i : i + 3], np.empty(0, dtype=np.int32))
+            candidates = (
+                found if candidates is None else np.intersect1d(candidates, found)
+            )
+        if candidates is None:
+            candidates = range(len(self.descriptions))
+
+        matches = np.zeros(len(self.descriptions), dtype=bool)
+        for code in candidates:
+            matches[code] = phrase in self.descriptions[code]
+        return matches[self.description_codes]
+
+    def query(self, start_date, size, description):
+        mask = np.ones(len(self.ids), dtype=bool)
+        if start_date:
+            start = datetime.combine(start_date, datetime.min.time(), timezone.utc)
+            mask &= self.start_times >= int(start.timestamp())
+        if size:
+            mask &= self.sizes == size
+        if description:
+            mask &= self._description_mask(description)
+        return np.flatnonzero(mask)
+
+    def print_rows(self, rows):
+        for row in rows:
+            started = datetime.fromtimestamp(self.start_times[row], timezone.utc)
+            print(
+                f"Snapshot ID: {self.ids[row]}, Started on: {started}, Size: {self.sizes[row]}GB, Description: {self.descriptions[self.description_codes[row]]}"
+            )
+
+
+def run_queries(queries_file, parser):
+    print("Loading all snapshots, please wait...")
+    table = SnapshotTable.load()
+    print(f"Loaded {len(table.ids)} snapshots.")
+
+    queries = sys.stdin if queries_file == "-" else open(queries_file)
+    with queries:
+        for line in queries:
+            if not line.strip():
+                continue
+            try:
+                query = parser.parse_args(shlex.split(line))
+            except SystemExit:
+                continue
+
+            started = time.perf_counter()
+            rows = table.query(query.start_date, query.size, query.description)
+            elapsed = (time.perf_counter() - started) * 1_000_000
+            print(f"Query: {line.strip()}")
+            table.print_rows(rows)
+            print(f"Found {len(rows)} matching snapshots in {elapsed:.0f}us.")
+            print()
 
 
 # Parse command line arguments
@@ -72,6 +209,14 @@ parser.add_argument("--size", type=int, help="The size of the volume in GB.")
 parser.add_argument(
     "--description", type=str, help="A phrase to search for in the description."
 )
+parser.add_argument(
+    "--queries",
+    type=str,
+    help='A file of queries, one set of the arguments above per line, answered from a single listing ("-" reads stdin).',
+)
 args = parser.parse_args()
 
-get_snapshots(args.start_date, args.size, args.description)
+if args.queries:
+    run_queries(args.queries, parser)
+else:
+    get_snapshots(args.start_date, args.size, args.description)
@@ -1,54 +1,170 @@
 import argparse
+import random
+import time
+from collections import deque
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
 
 import boto3
+import botocore.exceptions
 
 
 # Example usage:
 # python script_name.py 10 100 --status available --encrypted False --verbose
+# python script_name.py 1 16384 --migrate-gp3 --max-in-flight 100
 
 
-def list_ebs_volumes(min_size, max_size, status=None, encrypted=None, verbose=False):
-    # Initialize EC2 resource
-    ec2 = boto3.resource("ec2")
+def get_volumes(ec2, min_size, max_size, status=None, encrypted=None, volume_type=None):
+    paginator = ec2.get_paginator("describe_volumes")
 
     # Max number of filter values allowed per API call
     max_chunk_size = 195
 
-    # Iterate through chunks
-    for start_size in range(min_size, max_size + 1, max_chunk_size):
-        end_size = min(start_size + max_chunk_size - 1, max_size)
+    filters = []
 
-        # Build filters based on the current chunk
-        filters = [
+    # A narrow size range still fits in one size filter; wider ranges are
+    # checked client-side so the whole listing stays a single paginated scan
+    if max_size - min_size < max_chunk_size:
+        filters.append(
             {
                 "Name": "size",
-                "Values": [str(size) for size in range(start_size, end_size + 1)],
+                "Values": [str(size) for size in range(min_size, max_size + 1)],
             }
-        ]
-
-        # Optionally filter by status
-        if status:
-            filters.append({"Name": "status", "Values": [status]})
-
-        # Optionally filter by encryption
-        if encrypted is not None:
-            filters.append({"Name": "encrypted", "Values": [str(encrypted).lower()]})
-
-        # Retrieve volumes for the current chunk
-        volumes = ec2.volumes.filter(Filters=filters)
-
-        # Display volumes
-        for volume in volumes:
-            if verbose:
-                # Detailed output
-                print(f"Volume ID: {volume.id}")
-                print(f"  Size: {volume.size} GiB")
-                print(f"  State: {volume.state}")
-                print(f"  Encrypted: {volume.encrypted}")
-                print()
+        )
+
+    # Optionally filter by status
+    if status:
+        filters.append({"Name": "status", "Values": [status]})
+
+    # Optionally filter by encryption
+    if encrypted is not None:
+        filters.append({"Name": "encrypted", "Values": [str(encrypted).lower()]})
+
+    # Optionally filter by volume type
+    if volume_type:
+        filters.append({"Name": "volume-type", "Values": [volume_type]})
+
+    for page in paginator.paginate(Filters=filters):
+        for volume in page["Volumes"]:
+            if min_size <= volume["Size"] <= max_size:
+                yield volume
+
+
+def list_ebs_volumes(min_size, max_size, status=None, encrypted=None, verbose=False):
+    # Initialize EC2 client
+    ec2 = boto3.client("ec2")
+
+    # Display volumes
+    for volume in get_volumes(ec2, min_size, max_size, status, encrypted):
+        if verbose:
+            # Detailed output
+            print(f"Volume ID: {volume['VolumeId']}")
+            print(f"  Size: {volume['Size']} GiB")
+            print(f"  State: {volume['State']}")
+            print(f"  Encrypted: {volume['Encrypted']}")
+            print()
+        else:
+            # Minimal output - only volume IDs
+            print(volume["VolumeId"])
+
+
+# Latest modification of each volume, looked up with batched volume-id filters
+def get_volume_modifications(ec2, volume_ids, batch_size=200):
+    modifications = {}
+    paginator = ec2.get_paginator("describe_volumes_modifications")
+    for i in range(0, len(volume_ids), batch_size):
+        for page in paginator.paginate(
+            Filters=[{"Name": "volume-id", "Values": volume_ids[i : i + batch_size]}]
+        ):
+            for modification in page["VolumesModifications"]:
+                latest = modifications.get(modification["VolumeId"])
+                if not latest or modification["StartTime"] > latest["StartTime"]:
+                    modifications[modification["VolumeId"]] = modification
+    return modifications
+
+
+# gp3 settings that keep at least the volume's gp2 performance
+def get_gp3_settings(volume):
+    settings = {"VolumeType": "gp3", "Iops": max(3000, volume.get("Iops", 0))}
+    # gp2 volumes larger than 170 GiB can burst above gp3's 125 MiB/s baseline
+    if volume["Size"] > 170:
+        settings["Throughput"] = 250
+    return settings
+
+
+def modify_volume(ec2, volume, max_attempts=8):
+    for attempt in range(max_attempts):
+        try:
+            ec2.modify_volume(VolumeId=volume["VolumeId"], **get_gp3_settings(volume))
+            return None
+        except botocore.exceptions.ClientError as e:
+            throttled = e.response["Error"]["Code"] == "RequestLimitExceeded"
+            if not throttled or attempt == max_attempts - 1:
+                return str(e)
+            time.sleep(min(2**attempt, 30) + random.uniform(0, 1))
+
+
+def migrate_to_gp3(
+    min_size, max_size, status, encrypted, max_in_flight, poll_interval=30
+):
+    ec2 = boto3.client("ec2")
+    volumes = list(get_volumes(ec2, min_size, max_size, status, encrypted, "gp2"))
+    print(f"Found {len(volumes)} gp2 volumes to migrate.")
+
+    # A volume can only be modified again 6 hours after its last modification started
+    cooldown_start = datetime.now(timezone.utc) - timedelta(hours=6)
+    modifications = get_volume_modifications(ec2, [v["VolumeId"] for v in volumes])
+    queue = deque()
+    for volume in volumes:
+        modification = modifications.get(volume["VolumeId"])
+        if modification and modification["StartTime"] > cooldown_start:
+            print(f"Skipping {volume['VolumeId']}: modified in the last 6 hours.")
+        else:
+            queue.append(volume)
+
+    confirm = input(
+        f"You are about to convert {len(queue)} volumes to gp3. Proceed? (y/n): "
+    )
+    if confirm.lower() != "y":
+        print("Exiting without modifying any volumes.")
+        return
+
+    counts = {"migrated": 0, "failed": 0}
+    in_flight = set()
+    while queue or in_flight:
+        # Keep the pipeline full up to the in-flight limit
+        while queue and len(in_flight) < max_in_flight:
+            volume = queue.popleft()
+            error = modify_volume(ec2, volume)
+            if error:
+                counts["failed"] += 1
+                print(f"Error modifying volume: {volume['VolumeId']}. Error: {error}")
             else:
-                # Minimal output - only volume IDs
-                print(volume.id)
+                in_flight.add(volume["VolumeId"])
+
+        time.sleep(poll_interval)
+
+        # A volume is usable as gp3 once it leaves 'modifying'; optimizing
+        # carries on in the background without counting against the limit
+        for volume_id, modification in get_volume_modifications(
+            ec2, list(in_flight)
+        ).items():
+            state = modification["ModificationState"]
+            if state in ("optimizing", "completed"):
+                in_flight.discard(volume_id)
+                counts["migrated"] += 1
+                print(f"Migrated volume: {volume_id}")
+            elif state == "failed":
+                in_flight.discard(volume_id)
+                counts["failed"] += 1
+                print(
+                    f"Error modifying volume: {volume_id}. Error: {modification.get('StatusMessage')}"
+                )
+
+        print(
+            f"Migrated: {counts['migrated']}, In flight: {len(in_flight)}, Queued: {len(queue)}, Failed: {counts['failed']}"
+        )
 
 
 def main():
@@ -65,6 +181,17 @@ def main():
         "--encrypted", type=str, choices=["True", "False"], help="Encryption filter"
     )
     parser.add_argument("--verbose", action="store_true", help="Show detailed info")
+    parser.add_argument(
+        "--migrate-gp3",
+        action="store_true",
+        help="Convert the matching gp2 volumes to gp3 instead of listing them",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=50,
+        help="Maximum number of volumes being modified at once (default: 50)",
+    )
 
     args = parser.parse_args()
 
@@ -76,6 +203,11 @@ def main():
         encrypted = False
 
     # Call the function with the provided arguments
+    if args.migrate_gp3:
+        migrate_to_gp3(
+            args.min_size, args.max_size, args.status, encrypted, args.max_in_flight
+        )
+        return
     list_ebs_volumes(args.min_size, args.max_size, args.status, encrypted, args.verbose)
 
 
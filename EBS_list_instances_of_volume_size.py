@@ -7,8 +7,22 @@ import boto3
 def main(min_volume_size, filter_backup, csv_format):
     ec2_client = boto3.client("ec2")
 
+    # Get the size of every attached volume in one paginated listing
+    volume_sizes = {}
+    volume_paginator = ec2_client.get_paginator("describe_volumes")
+    for page in volume_paginator.paginate(
+        Filters=[{"Name": "attachment.status", "Values": ["attached"]}]
+    ):
+        for volume in page["Volumes"]:
+            volume_sizes[volume["VolumeId"]] = volume["Size"]
+
     # Get all instances
-    reservations = ec2_client.describe_instances()["Reservations"]
+    instance_paginator = ec2_client.get_paginator("describe_instances")
+    reservations = (
+        reservation
+        for page in instance_paginator.paginate()
+        for reservation in page["Reservations"]
+    )
 
     # Gather instances with volumes
     instances = []
@@ -27,17 +41,13 @@ def main(min_volume_size, filter_backup, csv_format):
             if filter_backup is not None and standard_backup != filter_backup:
                 continue
 
-            # Get attached volumes
+            # Get attached volumes and join them to their sizes
             volume_ids = [v["Ebs"]["VolumeId"] for v in instance["BlockDeviceMappings"]]
-            volumes = []
-
-            # Get volume sizes
-            for volume_id in volume_ids:
-                volume_info = ec2_client.describe_volumes(VolumeIds=[volume_id])[
-                    "Volumes"
-                ][0]
-                size = volume_info["Size"]
-                volumes.append({"volume_id": volume_id, "size": size})
+            volumes = [
+                {"volume_id": volume_id, "size": volume_sizes[volume_id]}
+                for volume_id in volume_ids
+                if volume_id in volume_sizes
+            ]
 
             # Check if any volume meets criteria
             if any(volume["size"] >= min_volume_size for volume in volumes):
@@ -59,9 +69,10 @@ def main(min_volume_size, filter_backup, csv_format):
 
     # Print the results
     if csv_format:
-        # CSV output
+        # CSV output, with as many volume columns as the largest instance needs
+        volume_columns = max((len(i["volumes"]) for i in instances), default=1)
         print("Instance Name,Instance ID,StandardBackup,", end="")
-        print(",".join([f"Volume ID {i+1},Size {i+1}" for i in range(5)]))
+        print(",".join([f"Volume ID {i+1},Size {i+1}" for i in range(volume_columns)]))
 
         for instance in instances:
             volumes_output = []
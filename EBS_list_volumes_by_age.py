@@ -1,5 +1,8 @@
 import argparse
 import sys
+from collections import defaultdict
+from datetime import datetime
+from datetime import timezone
 
 import boto3
 from dateutil.parser import parse
@@ -17,6 +20,58 @@ def list_volumes(state, date, verbose):
                     print(volume.id)
 
 
+# Upper bounds, in days, of the age buckets used by the report
+AGE_BUCKETS = [
+    (30, "0-30 days"),
+    (90, "30-90 days"),
+    (180, "90-180 days"),
+    (365, "180-365 days"),
+    (None, "365+ days"),
+]
+
+
+def get_age_bucket(age_days):
+    for limit, label in AGE_BUCKETS:
+        if limit is None or age_days < limit:
+            return label
+
+
+# Aggregate count and size per state and age bucket in one pass over the volumes
+def report_volumes(state, date, verbose):
+    ec2 = boto3.client("ec2")
+    paginator = ec2.get_paginator("describe_volumes")
+    filters = [] if state == "all" else [{"Name": "status", "Values": [state]}]
+
+    # Only the fields the report needs are kept from each page
+    volumes = paginator.paginate(Filters=filters).search(
+        "Volumes[].[VolumeId, State, Size, CreateTime]"
+    )
+
+    now = datetime.now(timezone.utc)
+    by_state = defaultdict(lambda: [0, 0])
+    by_age = defaultdict(lambda: [0, 0])
+    for volume_id, volume_state, size, create_time in volumes:
+        if date and create_time.replace(tzinfo=None) >= date:
+            continue
+        if verbose:
+            print(volume_id, volume_state, create_time)
+        for totals in (
+            by_state[volume_state],
+            by_age[get_age_bucket((now - create_time).days)],
+        ):
+            totals[0] += 1
+            totals[1] += size
+
+    print("State, Volumes, Total GiB")
+    for volume_state, (count, size) in sorted(by_state.items()):
+        print(f"{volume_state}, {count}, {size}")
+    print()
+    print("Age, Volumes, Total GiB")
+    for _, label in AGE_BUCKETS:
+        count, size = by_age.get(label, (0, 0))
+        print(f"{label}, {count}, {size}")
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="List all EBS volumes created before a certain date"
@@ -31,7 +86,6 @@ def main():
     parser.add_argument(
         "-d",
         "--date",
-        required=True,
         help="Only list volumes created before this date. Format: MM-DD-YYYY",
     )
     parser.add_argument(
@@ -41,15 +95,28 @@ def main():
         help="Print detailed information about each volume",
     )
 
+    parser.add_argument(
+        "-r",
+        "--report",
+        action="store_true",
+        help="Print volume counts and total GiB per state and age bucket instead of IDs",
+    )
+
     args = parser.parse_args()
 
+    if not args.date and not args.report:
+        parser.error("the following arguments are required: -d/--date")
+
     try:
-        date = parse(args.date)
+        date = parse(args.date) if args.date else None
     except ValueError:
         print("Invalid date format. Please use MM-DD-YYYY.")
         sys.exit(1)
 
-    list_volumes(args.state, date, args.verbose)
+    if args.report:
+        report_volumes(args.state, date, args.verbose)
+    else:
+        list_volumes(args.state, date, args.verbose)
 
 
 if __name__ == "__main__":
@@ -1,16 +1,56 @@
 import argparse
+import concurrent.futures
+from collections import deque
+from itertools import islice
 
 import boto3
 
+# Max number of filter values allowed per API call
+CHUNK_SIZE = 200
 
-def get_volume_ids(instance_ids):
-    ec2 = boto3.resource("ec2")
 
-    for instance_id in instance_ids:
-        instance = ec2.Instance(instance_id)
+def read_instance_id_chunks(file_path):
+    with open(file_path) as file:
+        instance_ids = (line.strip() for line in file if line.strip())
+        while chunk := list(islice(instance_ids, CHUNK_SIZE)):
+            yield chunk
+
+
+# Look up the volumes attached to a chunk of instances with one filtered listing
+def get_chunk_volumes(ec2_client, instance_ids):
+    volumes = {instance_id: [] for instance_id in instance_ids}
+    paginator = ec2_client.get_paginator("describe_volumes")
+    for page in paginator.paginate(
+        Filters=[{"Name": "attachment.instance-id", "Values": instance_ids}]
+    ):
+        for volume in page["Volumes"]:
+            for attachment in volume["Attachments"]:
+                if attachment["InstanceId"] in volumes:
+                    volumes[attachment["InstanceId"]].append(volume["VolumeId"])
+    return volumes
+
+
+def print_chunk_volumes(volumes):
+    for instance_id, volume_ids in volumes.items():
         print(f"Instance ID: {instance_id}")
-        for volume in instance.volumes.all():
-            print(f"  Volume ID: {volume.id}")
+        for volume_id in volume_ids:
+            print(f"  Volume ID: {volume_id}")
+
+
+def get_volume_ids(chunks, workers=8):
+    ec2_client = boto3.client("ec2")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in chunks:
+            # Keep the queue bounded so the file is read only as fast as the
+            # workers go, and print the oldest chunk first to keep input order
+            if len(pending) >= workers * 2:
+                print_chunk_volumes(pending.popleft().result())
+            pending.append(executor.submit(get_chunk_volumes, ec2_client, chunk))
+
+        while pending:
+            print_chunk_volumes(pending.popleft().result())
 
 
 def main():
@@ -23,12 +63,16 @@ def main():
         help="A file containing the list of AWS instance IDs, one per line.",
     )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="Number of chunks of 200 instances queried concurrently (default: 8).",
+    )
 
-    with open(args.instances) as file:
-        instance_ids = file.read().strip().split("\n")
+    args = parser.parse_args()
 
-    get_volume_ids(instance_ids)
+    get_volume_ids(read_instance_id_chunks(args.instances), args.workers)
 
 
 if __name__ == "__main__":
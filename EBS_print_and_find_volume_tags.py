@@ -1,27 +1,62 @@
 import argparse
 
 import boto3
+import botocore.exceptions
+
+# Max number of volume IDs sent in one describe_volumes call
+BATCH_SIZE = 500
+
+# Errors caused by a bad ID in the batch rather than by the request itself
+INVALID_ID_ERRORS = {"InvalidVolume.NotFound", "InvalidVolumeID.Malformed"}
+
+
+# Describe a batch of volumes, splitting it to isolate any missing or invalid IDs
+def describe_volume_batch(ec2, volume_ids, filters):
+    try:
+        response = ec2.describe_volumes(VolumeIds=volume_ids, Filters=filters)
+        return response["Volumes"], {}
+    except botocore.exceptions.ClientError as e:
+        code = e.response["Error"]["Code"]
+        if code not in INVALID_ID_ERRORS:
+            raise
+        if len(volume_ids) == 1:
+            return [], {volume_ids[0]: code}
+
+    middle = len(volume_ids) // 2
+    volumes, errors = describe_volume_batch(ec2, volume_ids[:middle], filters)
+    more_volumes, more_errors = describe_volume_batch(ec2, volume_ids[middle:], filters)
+    return volumes + more_volumes, errors | more_errors
 
 
 def get_volumes_info(volumes_list, tag_key=None, filter_tag=None):
-    ec2 = boto3.resource("ec2")
+    ec2 = boto3.client("ec2")
 
     with open(volumes_list) as f:
-        volumes = f.read().splitlines()
+        volumes = [line.strip() for line in f if line.strip()]
+
+    # Only volumes carrying the filter tag are returned by the API
+    filters = []
+    if filter_tag:
+        key, value = filter_tag.split("=", 1)
+        filters.append({"Name": f"tag:{key}", "Values": [value]})
 
-    for volume_id in volumes:
-        volume = ec2.Volume(volume_id)
-        tags = {t["Key"]: t["Value"] for t in volume.tags or []}
+    for i in range(0, len(volumes), BATCH_SIZE):
+        batch = volumes[i : i + BATCH_SIZE]
+        found, errors = describe_volume_batch(ec2, batch, filters)
+        found = {volume["VolumeId"]: volume for volume in found}
 
-        if filter_tag:
-            key, value = filter_tag.split("=")
-            if tags.get(key) != value:
+        for volume_id in batch:
+            if volume_id in errors:
+                print(f"Volume ID: {volume_id}, Error: {errors[volume_id]}")
+                continue
+            if volume_id not in found:
                 continue
 
-        if tag_key:
-            print(f"Volume ID: {volume_id}, Tag - {tag_key}: {tags.get(tag_key)}")
-        else:
-            print(f"Volume ID: {volume_id}, Tags: {tags}")
+            tags = {t["Key"]: t["Value"] for t in found[volume_id].get("Tags", [])}
+            if tag_key:
+                print(f"Volume ID: {volume_id}, Tag - {tag_key}: {tags.get(tag_key)}")
+            else:
+                print(f"Volume ID: {volume_id}, Tags: {tags}")
 
 
 def main():
@@ -1,14 +1,48 @@
 import argparse
 
 import boto3
+import botocore.exceptions
 
 # this scripts takes a file with instance ids and and a file with tags and applies those tags to the root volume of those instances
 # usagage: python script.py --instances instances.txt --tags tags.txt
 
 
+# Max number of IDs per describe_instances, create_tags and describe_volumes call
+BATCH_SIZE = 1000
+
+# Errors caused by a bad ID in the batch rather than by the request itself
+INVALID_ID_ERRORS = {"InvalidInstanceID.NotFound", "InvalidInstanceID.Malformed"}
+
+
 def read_file(filename):
     with open(filename) as file:
-        return [line.strip() for line in file]
+        return [line.strip() for line in file if line.strip()]
+
+
+def batches(items):
+    for i in range(0, len(items), BATCH_SIZE):
+        yield items[i : i + BATCH_SIZE]
+
+
+# Describe a batch of instances, splitting it to isolate any missing or invalid IDs
+def describe_instance_batch(ec2, instance_ids):
+    try:
+        response = ec2.describe_instances(InstanceIds=instance_ids)
+        return [
+            instance
+            for reservation in response["Reservations"]
+            for instance in reservation["Instances"]
+        ]
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] not in INVALID_ID_ERRORS:
+            raise
+        if len(instance_ids) == 1:
+            print(f"Error processing Instance ID {instance_ids[0]}: {e}")
+            return []
+
+    middle = len(instance_ids) // 2
+    instances = describe_instance_batch(ec2, instance_ids[:middle])
+    return instances + describe_instance_batch(ec2, instance_ids[middle:])
 
 
 def main():
@@ -39,33 +73,30 @@ def main():
     # Collect root volumes
     root_volumes = []
 
-    # Loop through the instance IDs
-    for instance_id in instance_ids:
-        # Describe the instance to get attached volume IDs and Tags
-        try:
-            response = ec2.describe_instances(InstanceIds=[instance_id])
-        except Exception as e:
-            print(f"Error processing Instance ID {instance_id}: {e}")
-            continue
-
-        instance = response["Reservations"][0]["Instances"][0]
-        block_device_mappings = instance["BlockDeviceMappings"]
-
-        # Extract the instance name from the tags
-        instance_name = None
-        for tag in instance.get("Tags", []):
-            if tag["Key"] == "Name":
-                instance_name = tag["Value"]
-                break
-
-        print(f"Processing Instance ID: {instance_id}, Instance Name: {instance_name}")
-
-        # Loop through the block device mappings
-        for block_device_mapping in block_device_mappings:
-            # Check if it is the root volume (device name usually is '/dev/sda1' or '/dev/xvda')
-            if block_device_mapping["DeviceName"] in ["/dev/sda1", "/dev/xvda"]:
-                root_volume_id = block_device_mapping["Ebs"]["VolumeId"]
-                root_volumes.append((instance_id, instance_name, root_volume_id))
+    # Describe the instances in batches to get attached volume IDs and Tags
+    for batch in batches(instance_ids):
+        for instance in describe_instance_batch(ec2, batch):
+            instance_id = instance["InstanceId"]
+
+            # Extract the instance name from the tags
+            instance_name = None
+            for tag in instance.get("Tags", []):
+                if tag["Key"] == "Name":
+                    instance_name = tag["Value"]
+                    break
+
+            print(
+                f"Processing Instance ID: {instance_id}, Instance Name: {instance_name}"
+            )
+
+            # The root volume is the one mapped at the instance's RootDeviceName
+            for block_device_mapping in instance["BlockDeviceMappings"]:
+                if (
+                    block_device_mapping["DeviceName"] == instance.get("RootDeviceName")
+                    and "Ebs" in block_device_mapping
+                ):
+                    root_volume_id = block_device_mapping["Ebs"]["VolumeId"]
+                    root_volumes.append((instance_id, instance_name, root_volume_id))
 
     # Print the volumes to be tagged
     print("The following root volumes will be tagged:")
@@ -79,9 +110,16 @@ def main():
         print("Tagging cancelled.")
         return
 
-    # Tag the volumes
-    for instance_id, instance_name, volume_id in root_volumes:
-        ec2.create_tags(Resources=[volume_id], Tags=tags)
+    # Tag the volumes, up to BATCH_SIZE per call
+    volume_ids = [volume_id for _, _, volume_id in root_volumes]
+    for batch in batches(volume_ids):
+        ec2.create_tags(Resources=batch, Tags=tags)
+
+    # Get the tags for every tagged volume
+    volume_tags = {}
+    for batch in batches(volume_ids):
+        for volume in ec2.describe_volumes(VolumeIds=batch)["Volumes"]:
+            volume_tags[volume["VolumeId"]] = volume.get("Tags", [])
 
     # Print confirmation
     print("\nThe following volumes have been tagged:")
@@ -89,11 +127,9 @@ def main():
         print(f"Instance ID: {instance_id}, Instance Name: {instance_name}")
         print(f"  Root Volume ID: {volume_id}")
 
-        # Get and print the tags for each volume
-        volume_info = ec2.describe_volumes(VolumeIds=[volume_id])
-        volume_tags = volume_info["Volumes"][0]["Tags"]
+        # Print the tags for each volume
         print(f"  Tags for volume {volume_id}:")
-        for tag in volume_tags:
+        for tag in volume_tags.get(volume_id, []):
             print(f"    Key: {tag['Key']}, Value: {tag['Value']}")
         print("\n")
 
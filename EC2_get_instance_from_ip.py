@@ -1,42 +1,249 @@
 import argparse
+import ipaddress
+import json
+import time
 
 import boto3
 
+# Max number of filter values allowed per API call
+CHUNK_SIZE = 200
+
+
+def chunks(items):
+    for i in range(0, len(items), CHUNK_SIZE):
+        yield items[i : i + CHUNK_SIZE]
+
+
+# Network interfaces holding any of the IPs, looked up by address, not by walking the fleet
+def get_matching_interfaces(ec2, ip_addresses):
+    wanted = set(ip_addresses)
+    # An interface holding IPs from two chunks is returned by both lookups
+    seen = set()
+    paginator = ec2.get_paginator("describe_network_interfaces")
+    for chunk in chunks(ip_addresses):
+        for page in paginator.paginate(
+            Filters=[{"Name": "addresses.private-ip-address", "Values": chunk}]
+        ):
+            for interface in page["NetworkInterfaces"]:
+                ips = {a["PrivateIpAddress"] for a in interface["PrivateIpAddresses"]}
+                if interface["NetworkInterfaceId"] in seen:
+                    continue
+                if ips & wanted and interface.get("Attachment", {}).get("InstanceId"):
+                    seen.add(interface["NetworkInterfaceId"])
+                    yield interface
+
+
+def get_running_instances(ec2, instance_ids):
+    instances = {}
+    paginator = ec2.get_paginator("describe_instances")
+    for chunk in chunks(instance_ids):
+        for page in paginator.paginate(
+            Filters=[
+                {"Name": "instance-id", "Values": chunk},
+                {"Name": "instance-state-name", "Values": ["running"]},
+            ]
+        ):
+            for reservation in page["Reservations"]:
+                for instance in reservation["Instances"]:
+                    instances[instance["InstanceId"]] = instance
+    return instances
+
 
 def find_ec2_instances(csv_file_path):
     # Read IP addresses from the CSV file
     with open(csv_file_path) as file:
-        ip_addresses = file.read().strip().split(",")
+        ip_addresses = [ip.strip() for ip in file.read().strip().split(",")]
 
     # Create a Boto3 session
     session = boto3.Session()
-    ec2 = session.resource("ec2")
+    ec2 = session.client("ec2")
 
-    # Retrieve EC2 instances
-    instances = ec2.instances.filter(
-        Filters=[{"Name": "instance-state-name", "Values": ["running"]}]
-    )
+    # Describe only the instances that own a matching interface
+    interfaces = list(get_matching_interfaces(ec2, ip_addresses))
+    instance_ids = list({i["Attachment"]["InstanceId"] for i in interfaces})
+    instances = get_running_instances(ec2, instance_ids)
+
+    # Print the details of each running instance with one of the IP addresses
+    for interface in interfaces:
+        instance = instances.get(interface["Attachment"]["InstanceId"])
+        if not instance:
+            continue
+        print(f"Instance ID: {instance['InstanceId']}")
+        print(f"Subnet: {interface['SubnetId']}")
+        print(f"VPC: {instance['VpcId']}")
+
+        # Get the instance name from the Name tag
+        instance_name = None
+        for tag in instance.get("Tags", []):
+            if tag["Key"] == "Name":
+                instance_name = tag["Value"]
+                break
+        print(f"Instance Name: {instance_name}")
+
+        # Print security groups
+        security_groups = [sg["GroupName"] for sg in instance["SecurityGroups"]]
+        print(f"Security Groups: {', '.join(security_groups)}")
+        print("\n")
+
+
+DEFAULT_INDEX_FILE = "ip_index.json"
+
+
+# Path-compressed binary (Patricia) trie node; bits holds the node's prefix
+# left-aligned in the address width
+class RadixNode:
+    __slots__ = ("bits", "length", "children", "entries")
+
+    def __init__(self, bits, length, entries=None):
+        self.bits = bits
+        self.length = length
+        self.children = [None, None]
+        self.entries = entries or []
+
+
+# Radix tree of IP addresses so exact and CIDR lookups walk at most one path
+class IpRadixTree:
+    def __init__(self):
+        self.roots = {4: RadixNode(0, 0), 6: RadixNode(0, 0)}
+        self.widths = {4: 32, 6: 128}
+
+    @staticmethod
+    def _bit(bits, index, width):
+        return (bits >> (width - 1 - index)) & 1
 
-    # Find instances with the given IP addresses and print their details
-    for instance in instances:
-        for interface in instance.network_interfaces:
-            if interface.private_ip_address in ip_addresses:
-                print(f"Instance ID: {instance.id}")
-                print(f"Subnet: {interface.subnet_id}")
-                print(f"VPC: {instance.vpc_id}")
+    @staticmethod
+    def _common_length(a, b, width):
+        return width - (a ^ b).bit_length()
 
-                # Get the instance name from the Name tag
-                instance_name = None
-                for tag in instance.tags:
-                    if tag["Key"] == "Name":
-                        instance_name = tag["Value"]
-                        break
-                print(f"Instance Name: {instance_name}")
+    @staticmethod
+    def _mask(bits, length, width):
+        return bits >> (width - length) << (width - length)
 
-                # Print security groups
-                security_groups = [sg["GroupName"] for sg in instance.security_groups]
-                print(f"Security Groups: {', '.join(security_groups)}")
-                print("\n")
+    def insert(self, address, entry):
+        ip = ipaddress.ip_address(address)
+        width = self.widths[ip.version]
+        key = int(ip)
+        node = self.roots[ip.version]
+        while node.length < width:
+            branch = self._bit(key, node.length, width)
+            child = node.children[branch]
+            if child is None:
+                node.children[branch] = RadixNode(key, width, [entry])
+                return
+            common = min(self._common_length(child.bits, key, width), child.length)
+            if common < child.length:
+                # Split the edge at the first bit where the keys differ
+                middle = RadixNode(self._mask(key, common, width), common)
+                middle.children[self._bit(child.bits, common, width)] = child
+                node.children[branch] = middle
+                if common == width:
+                    middle.entries.append(entry)
+                else:
+                    leaf = RadixNode(key, width, [entry])
+                    middle.children[self._bit(key, common, width)] = leaf
+                return
+            node = child
+        node.entries.append(entry)
+
+    # Every entry inside the queried address or network
+    def lookup(self, query):
+        network = ipaddress.ip_network(query, strict=False)
+        width = self.widths[network.version]
+        key = int(network.network_address)
+        node = self.roots[network.version]
+        while node.length < network.prefixlen:
+            node = node.children[self._bit(key, node.length, width)]
+            if node is None:
+                return []
+            common = self._common_length(node.bits, key, width)
+            if common < min(node.length, network.prefixlen):
+                return []
+
+        entries = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            entries.extend(node.entries)
+            stack.extend(child for child in node.children if child)
+        return entries
+
+
+# Who owns an ENI, from the fields describe_network_interfaces already returns
+def get_interface_owner(interface):
+    description = interface.get("Description", "")
+    instance_id = interface.get("Attachment", {}).get("InstanceId")
+    if instance_id:
+        return "instance", instance_id
+    if interface.get("InterfaceType") == "nat_gateway":
+        return "nat_gateway", description.rsplit(" ", 1)[-1]
+    if description.startswith("ELB "):
+        return "elb", description[len("ELB ") :]
+    if interface.get("InterfaceType") == "lambda" or description.startswith(
+        "AWS Lambda VPC ENI-"
+    ):
+        return "lambda", description[len("AWS Lambda VPC ENI-") :]
+    if interface.get("RequesterId") == "amazon-rds" or description.startswith("RDS"):
+        return "rds", description
+    return interface.get("InterfaceType", "interface"), description
+
+
+# One pass over every ENI, recording each private, public and IPv6 address
+def build_ip_index(ec2, index_file):
+    entries = []
+    paginator = ec2.get_paginator("describe_network_interfaces")
+    for page in paginator.paginate():
+        for interface in page["NetworkInterfaces"]:
+            owner_type, owner_id = get_interface_owner(interface)
+            details = {
+                "interface_id": interface["NetworkInterfaceId"],
+                "subnet_id": interface.get("SubnetId"),
+                "vpc_id": interface.get("VpcId"),
+                "owner_type": owner_type,
+                "owner_id": owner_id,
+            }
+            for address in interface.get("PrivateIpAddresses", []):
+                kind = "private" if address.get("Primary") else "secondary private"
+                entries.append(
+                    {"ip": address["PrivateIpAddress"], "kind": kind, **details}
+                )
+                if address.get("Association", {}).get("PublicIp"):
+                    entries.append(
+                        {
+                            "ip": address["Association"]["PublicIp"],
+                            "kind": "public",
+                            **details,
+                        }
+                    )
+            for address in interface.get("Ipv6Addresses", []):
+                entries.append(
+                    {"ip": address["Ipv6Address"], "kind": "ipv6", **details}
+                )
+
+    with open(index_file, "w") as f:
+        json.dump(entries, f)
+    print(f"Indexed {len(entries)} addresses into {index_file}")
+
+
+def load_ip_index(index_file):
+    tree = IpRadixTree()
+    with open(index_file) as f:
+        for entry in json.load(f):
+            tree.insert(entry["ip"], entry)
+    return tree
+
+
+def lookup_ips(index_file, queries):
+    tree = load_ip_index(index_file)
+    for query in queries:
+        started = time.perf_counter()
+        entries = tree.lookup(query)
+        elapsed = (time.perf_counter() - started) * 1_000_000
+        print(f"{query}: {len(entries)} addresses ({elapsed:.0f}us)")
+        for entry in entries:
+            print(
+                f"  {entry['ip']} ({entry['kind']}): {entry['owner_type']} {entry['owner_id']}, "
+                f"ENI {entry['interface_id']}, Subnet {entry['subnet_id']}, VPC {entry['vpc_id']}"
+            )
 
 
 if __name__ == "__main__":
@@ -44,8 +251,32 @@ if __name__ == "__main__":
         description="Find EC2 instances based on a CSV file of IP addresses"
     )
     parser.add_argument(
-        "csv_file", help="Path to the CSV file containing the IP addresses"
+        "csv_file", nargs="?", help="Path to the CSV file containing the IP addresses"
+    )
+    parser.add_argument(
+        "--build-index",
+        action="store_true",
+        help="Index every private, public and IPv6 address of every network interface",
+    )
+    parser.add_argument(
+        "--lookup",
+        nargs="+",
+        metavar="IP_OR_CIDR",
+        help="Find the owners of these addresses or networks in the index",
+    )
+    parser.add_argument(
+        "--index",
+        default=DEFAULT_INDEX_FILE,
+        help=f"IP index file (default: {DEFAULT_INDEX_FILE})",
     )
     args = parser.parse_args()
 
-    find_ec2_instances(args.csv_file)
+    if not (args.csv_file or args.build_index or args.lookup):
+        parser.error("provide a CSV file, --build-index or --lookup")
+
+    if args.build_index:
+        build_ip_index(boto3.Session().client("ec2"), args.index)
+    if args.lookup:
+        lookup_ips(args.index, args.lookup)
+    if args.csv_file:
+        find_ec2_instances(args.csv_file)
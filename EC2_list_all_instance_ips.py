@@ -1,38 +1,67 @@
+import argparse
+import concurrent.futures
+import csv
+import sys
+import threading
+
 import boto3
 
-# Create an EC2 resource object using the AWS SDK for Python (boto3)
-ec2 = boto3.resource("ec2")
-
-# Create an EC2 client
-client = boto3.client("ec2")
-
-# Use the filter() method of the instances collection to retrieve all running EC2 instances
-instances = ec2.instances.all()
-
-# Print the instance details
-for instance in instances:
-    # Fetch instance tags
-    tags = client.describe_tags(
-        Filters=[
-            {
-                "Name": "resource-id",
-                "Values": [
-                    instance.id,
-                ],
-            }
-        ]
-    )
+# Only the fields the listing prints; tags are already part of describe_instances
+PROJECTION = (
+    "Reservations[].Instances[].[Tags[?Key=='Name'].Value | [0], InstanceId,"
+    " PrivateIpAddress, PublicIpAddress, State.Name]"
+)
 
-    # Get the name tag which is the instance name
-    name_tags = [tag["Value"] for tag in tags["Tags"] if tag["Key"] == "Name"]
+# Rows from several regions share stdout, so writes are serialised
+write_lock = threading.Lock()
 
-    # Check if name tag is present, else default to 'No Name'
-    name = name_tags[0] if name_tags else "No Name"
 
-    # Get the instance state
-    state = instance.state["Name"]
+def list_instance_ips(writer, client, region=None):
+    paginator = client.get_paginator("describe_instances")
 
     # Print the name, instance ID, private IP, public IP, and state separated by commas
-    print(
-        f"{name},{instance.id},{instance.private_ip_address},{instance.public_ip_address},{state}"
+    for name, instance_id, private_ip, public_ip, state in paginator.paginate(
+        PaginationConfig={"PageSize": 1000}
+    ).search(PROJECTION):
+        row = [name or "No Name", instance_id, private_ip, public_ip, state]
+        if region:
+            row.append(region)
+        with write_lock:
+            writer.writerow(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="List the name, ID, IPs and state of every EC2 instance as CSV."
+    )
+    parser.add_argument(
+        "--regions",
+        nargs="+",
+        help="List these regions in parallel and add a region column",
     )
+    args = parser.parse_args()
+
+    writer = csv.writer(sys.stdout, lineterminator="\n")
+    session = boto3.Session()
+    if not args.regions:
+        list_instance_ips(writer, session.client("ec2"))
+        return
+
+    # Sessions are not thread-safe, so every regional client is created here
+    # before the pool starts; the clients themselves can be shared
+    clients = {
+        region: session.client("ec2", region_name=region) for region in args.regions
+    }
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=len(args.regions)
+    ) as executor:
+        futures = [
+            executor.submit(list_instance_ips, writer, clients[region], region)
+            for region in args.regions
+        ]
+        for future in futures:
+            future.result()
+
+
+if __name__ == "__main__":
+    main()